@@ -0,0 +1,279 @@
+import sys
+import time
+import random
+import numpy as np
+import pandas as pd
+
+def synthetic_isbndb(n, seed=0):
+    '''
+    Synthetic ISBNDB response data shaped like the master copy (data/extracted/isbn/cur_version).
+    Includes subtitles, parenthesized series names, duplicate editions and missing fields.
+    '''
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9))) for _ in range(5000)]
+    words += ['the', 'a', 'of', 'and', 'love', 'war', 'house', 'night']
+    first = [w.capitalize() for w in words[:800]]
+    last = [w.capitalize() for w in words[800:2000]]
+    rows = []
+    for i in range(n):
+        title = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 5))).title()
+        if rng.random() < 0.3:
+            title += ': A Novel'
+        if rng.random() < 0.1:
+            title += ' (' + rng.choice(words).title() + ' Series)'
+        authors = [f'{rng.choice(last)}, {rng.choice(first)}' for _ in range(rng.choice([1, 1, 1, 2]))]
+        if rng.random() < 0.02:
+            authors = None                                                          # missing authors
+        rows.append({
+            'publisher': rng.choice(words).title() + ' Press',
+            'title': title,
+            'pages': rng.randint(50, 900) if rng.random() > 0.05 else np.nan,
+            'date_published': str(rng.randint(1800, 2022)) if rng.random() > 0.05 else None,
+            'authors': authors,
+            'isbn': str(1000000000 + i),
+            'image': f'https://images.isbndb.com/covers/{i}.jpg',
+            'binding': rng.choice(['Paperback', 'Hardcover', 'Kindle Edition']),
+        })
+        if rng.random() < 0.1:
+            rows.append(dict(rows[-1]))                                             # exact duplicate
+    return pd.DataFrame(rows)
+
+def bench_transform_isbn(n=100000, worker_counts=(1, 2, 4, 8), repeat=1):
+    '''
+    Time transform_isbn across worker counts and check the output is identical to the single-process run.
+    Output: list of (workers, seconds, speedup)
+    '''
+    from twitterbooks import transform_isbn
+    df = synthetic_isbndb(n)
+    results = []
+    baseline, base_seconds = None, None
+    for workers in worker_counts:
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = transform_isbn(df, workers)
+            seconds.append(time.perf_counter() - start)
+        out_json = out.to_json()
+        if baseline is None:
+            baseline, base_seconds = out_json, min(seconds)
+        elif out_json != baseline:
+            raise Exception(f'transform_isbn output with {workers} workers differs from 1 worker')
+        results.append((workers, min(seconds), base_seconds / min(seconds)))
+        print(f'transform_isbn: {n} rows, {workers} workers: {min(seconds):.2f}s ({base_seconds / min(seconds):.2f}x)')
+    return results
+
+def synthetic_tweets(queries, n, mention_rate=0.05, seed=0):
+    '''
+    Synthetic tweet texts: random words, with a share of tweets mentioning a catalog book.
+    Input: transform_isbn queries to draw mentions from
+    '''
+    rng = random.Random(seed)
+    filler = ['just', 'finished', 'reading', 'love', 'this', 'book', 'the', 'and', 'of', 'to', 'my', 'new',
+              'today', 'great', 'so', 'good', 'lol', 'what', 'is', 'it', 'rt', 'via', 'https', 'co']
+    vocab = filler + [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9))) for _ in range(20000)]
+    tweets = []
+    for _ in range(n):
+        words = [rng.choice(vocab) for _ in range(rng.randint(5, 30))]
+        if rng.random() < mention_rate:
+            words += rng.choice(queries).strip('()').split('%20')
+            rng.shuffle(words)
+        tweets.append(' '.join(words))
+    return tweets
+
+def bench_matcher(books=170000, tweets=200000):
+    '''
+    Throughput of the streaming matcher against a full-size synthetic catalog.
+    Output: tweets per second
+    '''
+    from twitterbooks import transform_isbn
+    from matcher import StreamMatcher
+    queries = transform_isbn(synthetic_isbndb(books))['query'].tolist()
+    texts = synthetic_tweets(queries, tweets)
+    start = time.perf_counter()
+    m = StreamMatcher(queries)
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    mentions = m.consume(texts)
+    seconds = time.perf_counter() - start
+    print(f'matcher: {len(queries)} queries indexed in {build_seconds:.2f}s, {len(m.index.by_rarest)} index keys')
+    print(f'matcher: {tweets} tweets, {mentions} mentions in {seconds:.2f}s ({tweets / seconds:,.0f} tweets/s)')
+    return tweets / seconds
+
+def _run_engine(args):
+    '''
+    One engine from reading an ISBNDB master file (json lines) to writing the transformed rows as json,
+    in a fresh process so peaks don't carry over.
+    The timed run is repeated under tracemalloc, which slows Python allocations down, for the heap peak.
+    Output: (seconds, peak python heap bytes, peak arrow pool bytes, output rows)
+    '''
+    import tracemalloc
+    import pyarrow as pa
+    from twitterbooks import transform_isbn
+    from columnar import transform_isbn_arrow, read_isbndb_json
+    engine, path = args
+    def run():
+        if engine == 'arrow':
+            out = transform_isbn_arrow(read_isbndb_json(path)).to_pandas()
+        else:
+            out = transform_isbn(pd.read_json(path, orient='records', lines=True, dtype=False))
+        out.to_json(f'{path}.{engine}.out', orient='records', lines=True)
+        return out.shape[0]
+    start = time.perf_counter()
+    rows = run()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    run()
+    heap = tracemalloc.get_traced_memory()[1]
+    return seconds, heap, pa.default_memory_pool().max_memory(), rows
+
+def bench_engines(n=100000):
+    '''
+    Memory and throughput of the pandas and Arrow engines of transform_isbn, from a json lines master file
+    to the json write; checks that both engines return the same rows.
+    '''
+    import tempfile
+    from lib import map_processes
+    df = synthetic_isbndb(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = f'{tmp}/isbndb.jsonl'
+        df.to_json(path, orient='records', lines=True)
+        for engine in ['pandas', 'arrow']:
+            seconds, heap, pool, rows = map_processes(_run_engine, [(engine, path)])[0]
+            print(f'transform_isbn {engine}: {n} rows -> {rows} in {seconds:.2f}s ({n / seconds:,.0f} rows/s), '
+                  f'peak python heap {heap / 2**20:.0f} MiB, peak arrow pool {pool / 2**20:.0f} MiB')
+        queries = [pd.read_json(f'{path}.{engine}.out', orient='records', lines=True)['query'].tolist() for engine in ['pandas', 'arrow']]
+        if queries[0] != queries[1]:
+            raise Exception('Arrow and pandas transform_isbn outputs differ')
+
+def bench_pipeline(chunks=20, chunk_size=1000, fetch_ms=500, publish_ms=20):
+    '''
+    End-to-end latency of the batch and streaming modes of twitterbooks on synthetic data.
+    ISBNDB and SNS are simulated with sleeps; transform and packing are the real ones.
+    Output: (batch seconds to first publish, batch total, stream seconds to first publish, stream total)
+    '''
+    from lib import build_tweet_counts_query, get_sns_batches
+    from twitterbooks import transform_isbn
+    from pipeline import stream_books
+    data = synthetic_isbndb(chunks * chunk_size)
+    isbn_chunks = [data.iloc[i:i + chunk_size] for i in range(0, data.shape[0], chunk_size)]
+    def fetch(chunk):
+        time.sleep(fetch_ms / 1000)
+        return chunk.reset_index(drop=True)
+    first = []
+    def publish(batch):
+        first.append(time.perf_counter())
+        time.sleep(publish_ms / 1000)
+        return 0
+
+    # batch: every stage over all books before the next
+    first.clear()
+    start = time.perf_counter()
+    booksdf = pd.concat([fetch(chunk) for chunk in isbn_chunks])
+    tdf = transform_isbn(booksdf.reset_index(drop=True))
+    for batch in get_sns_batches(build_tweet_counts_query(tdf['query'])):
+        publish(batch)
+    batch_first, batch_total = first[0] - start, time.perf_counter() - start
+
+    # stream: chunks flow through the stages
+    first.clear()
+    start = time.perf_counter()
+    _, published, _ = stream_books(isbn_chunks, fetch, transform_isbn, publish)
+    stream_first, stream_total = first[0] - start, time.perf_counter() - start
+    print(f'pipeline: {data.shape[0]} books in {chunks} ISBNDB chunks ({fetch_ms} ms each), {publish_ms} ms per SNS batch')
+    print(f'batch:  first publish {batch_first:.2f}s, done {batch_total:.2f}s, {tdf.shape[0]} books')
+    print(f'stream: first publish {stream_first:.2f}s, done {stream_total:.2f}s, {len(published)} books')
+    return batch_first, batch_total, stream_first, stream_total
+
+def bench_credentials(urls=600, quota=50, window=1000, latency=5, token_counts=(1, 2, 4)):
+    '''
+    Counts throughput with 1, 2, 4... bearer tokens against a local fake API enforcing a quota per token and window
+    (window and latency in milliseconds); checks that the merged counts are identical for every pool size.
+    Output: list of (tokens, seconds, requests per second)
+    '''
+    from pool import CredentialPool, FakeCountsAPI, merge_counts
+    url_list = [f'https://api.twitter.com/2/tweets/counts/recent?query=(book%20{i})' for i in range(urls)]
+    results, baseline = [], None
+    for n in token_counts:
+        api = FakeCountsAPI(quota, window / 1000, latency / 1000)
+        pool = CredentialPool([f'token{t:04d}' for t in range(n)], fetch=api)
+        start = time.perf_counter()
+        merged = merge_counts(url_list, pool.run(url_list))
+        seconds = time.perf_counter() - start
+        baseline = merged if baseline is None else baseline
+        if not merged.equals(baseline):
+            raise Exception(f'Counts merged from {n} tokens differ from 1 token')
+        throttled = sum(s['throttled'] for s in pool.stats())
+        results.append((n, seconds, urls / seconds))
+        print(f'credentials: {urls} requests, {n} tokens x {quota}/{window} ms: {seconds:.2f}s ({urls / seconds:,.0f} req/s), {throttled} 429s')
+    return results
+
+def bench_transport(requests_count=200, latency=2):
+    '''
+    Small-request latency against a local HTTPS server (latency in milliseconds per response):
+    a new connection per request, as module-level requests calls make, versus the shared keep-alive transport.
+    Output: (seconds per request without pooling, seconds per request with the transport)
+    '''
+    import ssl
+    import tempfile
+    import threading
+    import subprocess
+    import requests
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from transport import Transport
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'                                               # keep-alive
+        disable_nagle_algorithm = True
+        def do_GET(self):
+            time.sleep(latency / 1000)
+            body = b'{"data": [], "meta": {"total_tweet_count": 0}}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = f'{tmp}/cert.pem', f'{tmp}/key.pem'
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                        '-days', '1', '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost'],
+                       check=True, capture_output=True)
+        server = ThreadingHTTPServer(('localhost', 0), Handler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'https://localhost:{server.server_address[1]}/2/tweets/counts/recent?query=(book)'
+
+        start = time.perf_counter()
+        for _ in range(requests_count):
+            requests.get(url, verify=cert).json()
+        unpooled = (time.perf_counter() - start) / requests_count
+
+        transport = Transport()
+        start = time.perf_counter()
+        for _ in range(requests_count):
+            transport.get(url, verify=cert).json()
+        pooled = (time.perf_counter() - start) / requests_count
+        transport.close()
+        server.shutdown()
+    print(f'transport: {requests_count} HTTPS requests, {latency} ms server latency')
+    print(f'new connection per request: {unpooled * 1000:.1f} ms/request')
+    print(f'shared keep-alive transport: {pooled * 1000:.1f} ms/request ({unpooled / pooled:.1f}x)')
+    return unpooled, pooled
+
+if __name__ == '__main__':
+    # python bench.py transform_isbn [rows]
+    # python bench.py matcher [books] [tweets]
+    # python bench.py engines [rows]
+    # python bench.py pipeline [chunks] [chunk_size] [fetch_ms] [publish_ms]
+    # python bench.py credentials [urls] [quota] [window_ms] [latency_ms]
+    # python bench.py transport [requests] [latency_ms]
+    benches = {'transform_isbn': bench_transform_isbn, 'matcher': bench_matcher, 'engines': bench_engines,
+               'pipeline': bench_pipeline, 'credentials': bench_credentials,
+               'transport': bench_transport}
+    name = sys.argv[1] if len(sys.argv) > 1 else 'transform_isbn'
+    args = [int(a) for a in sys.argv[2:]]
+    benches[name](*args)
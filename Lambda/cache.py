@@ -0,0 +1,120 @@
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from urllib.parse import urlsplit, unquote
+
+def normalize_counts_query(query):
+    '''
+    Normalize a Twitter counts query so that equivalent requests share one cache key.
+    Words within a book query are and-ed, so they are deduplicated and sorted.
+    Book queries are or-ed, so they are deduplicated and sorted as well.
+    Input: query string, url-encoded or not, e.g. "(waves%20virginia%20woolf)%20OR%20(...)"
+    Output: normalized query string
+    '''
+    # split on the OR operator before lowercasing: book queries are lowercase and may contain the word "or"
+    terms = unquote(query).split(' OR ')
+    normalized = set()
+    for term in terms:
+        words = term.lower().replace('(', ' ').replace(')', ' ').split()
+        if len(words) > 0:
+            normalized.add('(' + ' '.join(sorted(set(words))) + ')')
+    return ' OR '.join(sorted(normalized))
+
+def parse_counts_url(url):
+    '''
+    Split a Twitter counts url into its query and time window.
+    Output: (query, start_time, end_time, granularity), missing parameters are ''
+    '''
+    # parse_qs would turn '+' into spaces, so split the raw query string instead
+    params = {}
+    for pair in urlsplit(url).query.split('&'):
+        if '=' in pair:
+            k, v = pair.split('=', 1)
+            params[k] = v
+    return (params.get('query', ''), unquote(params.get('start_time', '')),
+            unquote(params.get('end_time', '')), params.get('granularity', 'hour'))
+
+def counts_cache_key(query, start_time='', end_time='', granularity='hour'):
+    '''Content address of a counts request: hash of the normalized query plus the time window'''
+    key = json.dumps([normalize_counts_query(query), start_time, end_time, granularity])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class CountsCache():
+    def __init__(self, ttl=3600, max_entries=10000, s3=None, bucket='', prefix='data/cache/twitter_counts'):
+        '''
+        Content-addressed cache of Twitter counts responses.
+        Entries are kept in memory (least recently used are evicted past max_entries)
+        and, if an s3 client is given, shared through S3 between the batch layer and the app.
+        Each reader applies its own ttl, so the app can be stricter than the batch layer.
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _s3_key(self, key):
+        return f'{self.prefix}/{key[:2]}/{key}.json'
+
+    def _remember(self, key, stored_at, response):
+        '''Insert into memory and evict least recently used entries'''
+        self.entries[key] = (stored_at, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, url):
+        '''
+        Look up a counts url without touching the Twitter API.
+        Output: cached json response or None
+        '''
+        key = counts_cache_key(*parse_counts_url(url))
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] + self.ttl < now:
+            self.entries.pop(key, None)                                             # expired in memory
+            entry = None
+        if entry is None and self.s3 is not None:
+            try:                                                                    # another worker may have fetched it
+                obj = self.s3.get_object(Bucket=self.bucket, Key=self._s3_key(key))
+                stored = json.loads(obj['Body'].read())
+                if stored['stored_at'] + self.ttl >= now:
+                    entry = (stored['stored_at'], stored['response'])
+                    self._remember(key, *entry)
+            except Exception:
+                entry = None                                                        # not cached yet or unreadable
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, url, response):
+        '''Store a successful counts response for url'''
+        key = counts_cache_key(*parse_counts_url(url))
+        stored_at = time.time()
+        self._remember(key, stored_at, response)
+        if self.s3 is not None:
+            try:
+                self.s3.put_object(Bucket=self.bucket, Key=self._s3_key(key),
+                                   Body=json.dumps({'stored_at': stored_at, 'url': url, 'response': response}))
+            except Exception as e:
+                print(e)                                                            # the memory entry is still usable
+        return None
+
+    def get_or_fetch(self, url, fetch):
+        '''
+        Serve url from the cache or call fetch(url) and cache its result.
+        fetch returns the json response, or None if the request should not be cached (e.g. 429)
+        '''
+        response = self.get(url)
+        if response is None:
+            response = fetch(url)
+            if response is not None:
+                self.put(url, response)
+        return response
@@ -0,0 +1,142 @@
+import os
+import mmap
+import struct
+import numpy as np
+import pandas as pd
+
+MAGIC = b'TBCAT001'
+HEADER = struct.Struct('<8sQQQQQQQ')    # magic, records, strings, string offsets, string data, records, title order, author order
+RECORD = np.dtype([('isbn', '<u4'), ('title', '<u4'), ('title_short', '<u4'), ('authors', '<u4'), ('query', '<u4'),
+                   ('title_key', '<u4'), ('author_key', '<u4'), ('year', '<i2'), ('mentions', '<i8')])
+
+def _align(n):
+    return (n + 7) // 8 * 8
+
+def write_catalog(df, path):
+    '''
+    Write the book dimension as a compact file that can be memory-mapped by the app.
+    Strings are interned into one pool; records are sorted by isbn and refer to strings by id;
+    title and author orders are record ids sorted by lowercase title and author for prefix search.
+    Input: pandas dataframe with isbn, title, title_short, authors, query, date_published, optional mentions
+    '''
+    df = df.drop_duplicates(subset=['isbn'])
+    pool = {}
+    def intern(s):
+        s = '' if pd.isna(s) else str(s)
+        if s not in pool:
+            pool[s] = len(pool)
+        return pool[s]
+
+    years = pd.to_numeric(df['date_published'].astype(str).str[:4], errors='coerce').fillna(-1).astype(int)
+    mentions = df['mentions'].fillna(-1).astype('int64') if 'mentions' in df.columns else pd.Series(-1, index=df.index)
+    rows = sorted(zip(df['isbn'].astype(str), df['title'], df['title_short'], df['authors'], df['query'], years, mentions),
+                  key=lambda r: r[0].encode('utf-8'))
+    records = np.zeros(len(rows), dtype=RECORD)
+    for i, (isbn, title, title_short, authors, query, year, count) in enumerate(rows):
+        records[i] = (intern(isbn), intern(title), intern(title_short), intern(authors), intern(query),
+                      intern(str(title).lower()), intern(str(authors).lower()), year, count)
+
+    strings = [s.encode('utf-8') for s in pool]                                     # dicts keep insertion order = id
+    offsets = np.zeros(len(strings) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(s) for s in strings])
+    data = b''.join(strings)
+    title_order = np.array(sorted(range(len(rows)), key=lambda i: strings[records[i]['title_key']]), dtype='<u4')
+    author_order = np.array(sorted(range(len(rows)), key=lambda i: strings[records[i]['author_key']]), dtype='<u4')
+
+    # sections are 8-byte aligned so that they can be viewed in place
+    offsets_at = _align(HEADER.size)
+    data_at = offsets_at + offsets.nbytes
+    records_at = _align(data_at + len(data))
+    title_at = records_at + records.nbytes
+    author_at = _align(title_at + title_order.nbytes)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(rows), len(strings), offsets_at, data_at, records_at, title_at, author_at))
+        for at, section in [(offsets_at, offsets.tobytes()), (data_at, data), (records_at, records.tobytes()),
+                            (title_at, title_order.tobytes()), (author_at, author_order.tobytes())]:
+            f.write(b'\0' * (at - f.tell()))
+            f.write(section)
+    os.replace(tmp_path, path)                                                      # readers never see a partial file
+    return len(rows)
+
+class MappedCatalog():
+    def __init__(self, path):
+        '''
+        Read-only, memory-mapped view of a file written by write_catalog.
+        Nothing is parsed up front; pages are loaded by the OS on access and shared between processes.
+        '''
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, n_strings, offsets_at, data_at, records_at, title_at, author_at = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception(f'{path} is not a catalog file')
+        self.size = n
+        self.offsets = np.frombuffer(self.mm, dtype='<u8', count=n_strings + 1, offset=offsets_at)
+        self.data_at = data_at
+        self.records = np.frombuffer(self.mm, dtype=RECORD, count=n, offset=records_at)
+        self.orders = {
+            'title': np.frombuffer(self.mm, dtype='<u4', count=n, offset=title_at),
+            'author': np.frombuffer(self.mm, dtype='<u4', count=n, offset=author_at),
+        }
+
+    def __len__(self):
+        return self.size
+
+    def _bytes(self, sid):
+        start = self.data_at + int(self.offsets[sid])
+        return self.mm[start:self.data_at + int(self.offsets[sid + 1])]
+
+    def string(self, sid):
+        return self._bytes(sid).decode('utf-8')
+
+    def record(self, i):
+        '''Book details for record position i'''
+        r = self.records[i]
+        return {'isbn': self.string(r['isbn']), 'title': self.string(r['title']), 'title_short': self.string(r['title_short']),
+                'authors': self.string(r['authors']), 'query': self.string(r['query']),
+                'year': int(r['year']), 'mentions': int(r['mentions'])}
+
+    def _lower_bound(self, n, key_at, target):
+        '''First position in [0, n) whose key is >= target'''
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key_at(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, isbn):
+        '''Book details by isbn in O(log n), or None'''
+        target = str(isbn).encode('utf-8')
+        i = self._lower_bound(self.size, lambda i: self._bytes(self.records[i]['isbn']), target)
+        if i < self.size and self._bytes(self.records[i]['isbn']) == target:
+            return self.record(i)
+        return None
+
+    def prefix(self, prefix, by='title', limit=20):
+        '''
+        Books whose lowercase title or author starts with prefix, in alphabetical order.
+        Input: prefix, by: 'title' or 'author', limit: max number of results
+        '''
+        order = self.orders[by]
+        field = 'title_key' if by == 'title' else 'author_key'
+        target = prefix.lower().encode('utf-8')
+        i = self._lower_bound(self.size, lambda i: self._bytes(self.records[order[i]][field]), target)
+        results = []
+        while i < self.size and len(results) < limit and self._bytes(self.records[order[i]][field]).startswith(target):
+            results.append(self.record(order[i]))
+            i += 1
+        return results
+
+_open_catalogs = {}
+
+def open_catalog(path):
+    '''Open a catalog once per process and file version; reopens after the file is replaced'''
+    version = (path, os.stat(path).st_mtime_ns)
+    if version not in _open_catalogs:
+        _open_catalogs.clear()                                                      # older versions stay valid for existing readers
+        _open_catalogs[version] = MappedCatalog(path)
+    return _open_catalogs[version]
@@ -0,0 +1,164 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.json as pj
+import pyarrow.compute as pc
+
+# Arrow engine for transform_isbn, from the ISBNDB master files (json lines) to the transformed rows.
+# Strings stay in Arrow buffers and are changed with Arrow's vectorized (RE2) string kernels;
+# per-word work runs in numpy over dictionary codes instead of Python lists and sets.
+# Written against the pyarrow version pinned in requirements.txt (6.x): no Table.join or group_by.
+
+ISBNDB_COLUMNS = ['publisher','title','pages','date_published','authors','isbn','image','binding']
+ISBNDB_SCHEMA = pa.schema([('publisher', pa.string()), ('title', pa.string()), ('pages', pa.float64()),
+                           ('date_published', pa.string()), ('authors', pa.list_(pa.string())), ('isbn', pa.string()),
+                           ('image', pa.string()), ('binding', pa.string())])
+RM_WORDS = ['a','an','the','dr','mr','mrs','prof','msgr','rev','rt','sr','jr','phd','lcsw','esq']
+RM_CHARS = [r'\(.*?\)', r'<.*?>']
+NON_WORD = r'[^\p{L}\p{N}_]'                                                         # python's \W in RE2
+
+def _combine(arr):
+    return arr.combine_chunks() if isinstance(arr, pa.ChunkedArray) else arr
+
+def _numpy(arr):
+    '''Numpy view of a non-null numeric array'''
+    return _combine(arr).to_numpy(zero_copy_only=False)
+
+def codes(arr):
+    '''Dictionary codes of an array as int64 numpy array; nulls get -1'''
+    encoded = _combine(arr).dictionary_encode()
+    return _numpy(pc.fill_null(encoded.indices.cast(pa.int64()), -1))
+
+def first_unique(keys):
+    '''Sorted positions of the first occurrence of each distinct row of a 2-d integer key array'''
+    keys = np.ascontiguousarray(keys)
+    if keys.shape[0] == 0:
+        return np.zeros(0, dtype='int64')
+    rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+    _, first = np.unique(rows, return_index=True)
+    return np.sort(first)
+
+def drop_duplicates(table, columns=None):
+    '''Keep the first of rows that are equal in columns (default: all), like pandas drop_duplicates'''
+    columns = columns or table.column_names
+    keys = np.stack([codes(table[c]) for c in columns], axis=1) if table.num_rows > 0 else np.zeros((0, 1), 'int64')
+    return table.take(pa.array(first_unique(keys)))
+
+def remove_regex(arr, rm_words, rm_chars):
+    '''Arrow version of lib.remove_regex with code_space and add_paren'''
+    def remove_words(arr):
+        for r in rm_words:
+            arr = pc.replace_substring_regex(arr, ' ' + r + ' ', ' ')
+            arr = pc.replace_substring_regex(arr, ' ' + r + '$', '')
+            arr = pc.replace_substring_regex(arr, '^' + r + ' ', '')
+            arr = pc.replace_substring(arr, '  ', ' ')
+        return arr
+    arr = remove_words(arr)
+    for r in rm_chars:
+        arr = pc.replace_substring_regex(arr, r, ' ')
+    arr = remove_words(arr)
+    arr = pc.replace_substring_regex(arr, NON_WORD, ' ')
+    arr = pc.replace_substring_regex(arr, ' {2,}', ' ')
+    arr = pc.utf8_trim_whitespace(arr)
+    arr = pc.replace_substring(arr, ' ', '%20')
+    return pc.replace_substring_regex(arr, '(?s)^(.*)$', '(\\1)')
+
+def sorted_words(*arrays):
+    '''Distinct words of list<string> arrays in code point order, like python's sorted()'''
+    words = pc.unique(pa.concat_arrays([_combine(pc.list_flatten(a)) for a in arrays]))
+    return words.take(pc.sort_indices(words))
+
+def word_codes(lists, words):
+    '''Flatten a list<string> array into (row, code) numpy arrays, codes indexing words'''
+    lists = _combine(lists)
+    rows = _numpy(pc.list_parent_indices(lists)).astype('int64')
+    return rows, _numpy(pc.index_in(pc.list_flatten(lists), value_set=words)).astype('int64')
+
+def word_sets(rows, code, n, k):
+    '''Per row: sorted unique (row, code) keys, number of distinct words, and min/max count of a word'''
+    keys, counts = np.unique(rows * k + code, return_counts=True)
+    key_rows = keys // k
+    distinct = np.bincount(key_rows, minlength=n)
+    lo = np.full(n, np.iinfo('int64').max)
+    hi = np.zeros(n, dtype='int64')
+    np.minimum.at(lo, key_rows, counts)
+    np.maximum.at(hi, key_rows, counts)
+    return keys, distinct, lo, hi
+
+def transform_isbn_arrow(table):
+    '''
+    Arrow engine for twitterbooks.transform_isbn, with the same rows and values.
+    Input: pyarrow table of ISBNDB data (authors as list<string>)
+    Output: pyarrow table with index (input row number), ISBNDB columns, title_short and query
+    '''
+    # Choose columns of interest, keep the input row number as the pandas engine's reset_index does
+    table = table.select(ISBNDB_COLUMNS)
+    table = table.append_column('index', pa.array(np.arange(table.num_rows, dtype='int64')))
+
+    # Handle authors
+    table = table.filter(pc.is_valid(table['authors']))
+    authors = pc.utf8_trim_whitespace(pc.binary_join(table['authors'], ' '))
+    table = table.set_column(table.schema.get_field_index('authors'), 'authors', authors)
+    table = table.filter(pc.not_equal(table['authors'], ''))
+    table = drop_duplicates(table, ISBNDB_COLUMNS)
+
+    # Handle titles, build query from author and title
+    title_short = pc.replace_substring_regex(table['title'], '(?s):.*', '')
+    query = pc.utf8_lower(pc.binary_join_element_wise(title_short, table['authors'], ' '))
+    table = table.append_column('title_short', title_short)
+    table = table.append_column('query', remove_regex(query, RM_WORDS, RM_CHARS))
+
+    # Clean up: has page count and pub date
+    pages = table['pages']
+    has_pages = pc.is_valid(pages)
+    if pa.types.is_floating(pages.type):
+        has_pages = pc.and_(has_pages, pc.invert(pc.is_nan(pages)))
+    table = table.filter(pc.and_(has_pages, pc.is_valid(table['date_published'])))
+    n = table.num_rows
+
+    # Words of queries and author names, coded against one sorted dictionary
+    qlists = pc.split_pattern(pc.replace_substring_regex(table['query'], '(?s)^.(.*).$', '\\1'), '%20')
+    alists = pc.split_pattern(pc.replace_substring(pc.replace_substring(pc.utf8_lower(table['authors']), ',', ''), '.', ''), ' ')
+    words = sorted_words(qlists, alists)
+    k = max(len(words), 1)
+    qrows, qcodes = word_codes(qlists, words)
+    arows, acodes = word_codes(alists, words)
+    qkeys, qdistinct, lo, hi = word_sets(qrows, qcodes, n, k)
+    akeys, adistinct, _, _ = word_sets(arows, acodes, n, k)
+
+    # Must have more than 2 unique words, and not be a phrase repeated with no other words
+    keep = (qdistinct >= 3) & ~((lo == 2) & (hi == 2))
+
+    # Queries that are only author names: equal word sets
+    common = np.bincount(np.intersect1d(qkeys, akeys, assume_unique=True) // k, minlength=n)
+    author_only = (qdistinct == adistinct) & (qdistinct == common)
+
+    # Sort words in queries to catch more duplicates
+    order = np.lexsort((qcodes, qrows))
+    offsets = np.concatenate([[0], np.cumsum(_numpy(pc.list_value_length(_combine(qlists))))]).astype('int32')
+    sorted_lists = pa.ListArray.from_arrays(pa.array(offsets), words.take(pa.array(qcodes[order])))
+    query = pc.replace_substring_regex(pc.binary_join(sorted_lists, '%20'), '(?s)^(.*)$', '(\\1)')
+    table = table.set_column(table.schema.get_field_index('query'), 'query', query)
+
+    # Drop duplicates on sorted query, keep first, then queries that are only author names
+    table = table.filter(pa.array(keep))
+    author_only = author_only[keep]
+    first = first_unique(codes(table['query'])[:, None])
+    table = table.take(pa.array(first)).filter(pa.array(~author_only[first]))
+    return table.select(['index'] + ISBNDB_COLUMNS + ['title_short', 'query'])
+
+def from_isbndb_frame(df):
+    '''Arrow table of the ISBNDB columns of a pandas dataframe; authors that aren't lists become nulls'''
+    df = df[ISBNDB_COLUMNS].copy()
+    df['authors'] = df['authors'].where(df['authors'].map(lambda x: isinstance(x, list)), None)
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def read_isbndb_json(source):
+    '''
+    Arrow table of an ISBNDB master file in json lines, parsed by Arrow's json reader without pandas.
+    Columns other than the ISBNDB columns are skipped; missing ones are nulls.
+    Input: file path, or buffer/file-like object with the file's bytes
+    Output: pyarrow table with ISBNDB_SCHEMA
+    '''
+    source = pa.BufferReader(source) if isinstance(source, (bytes, bytearray)) else source
+    options = pj.ParseOptions(explicit_schema=ISBNDB_SCHEMA, unexpected_field_behavior='ignore')
+    return pj.read_json(source, parse_options=options).select(ISBNDB_COLUMNS)
@@ -0,0 +1,165 @@
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+
+def to_hour(timestamp):
+    '''Hours since the epoch for a Twitter bucket timestamp, e.g. "2022-02-01T13:00:00.000Z"'''
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp()) // 3600
+
+def url_query(request_url):
+    '''Query part of a twitter counts url, without start_time and other parameters'''
+    return request_url.split('query=')[-1].split('&')[0]
+
+class HourlyCounts():
+    def __init__(self, path, hours=192, create=False):
+        '''
+        Dense books x hours tweet counts, memory-mapped from path + '.bin' with metadata in path + '.json'.
+        The time axis is a ring buffer: the column for hour h is h % hours,
+        and columns are zeroed as the newest hour (head) moves forward.
+        Rolling totals, sparklines and rankings are reductions over the mapped array.
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        if create or not os.path.exists(path + '.json'):
+            self.hours = hours
+            self.head = -1                                                          # newest hour, -1: empty
+            self.keys = []
+            self._map(16, create=True)
+        else:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            self.hours = meta['hours']
+            self.head = meta['head']
+            self.keys = meta['keys']
+            self._map(meta['capacity'])
+        self.rows = {k: i for i, k in enumerate(self.keys)}
+
+    def _map(self, capacity, create=False):
+        '''(Re)map the array file with room for capacity rows; existing rows are kept'''
+        mode = 'w+' if create else 'r+'
+        if not create and os.path.getsize(self.path + '.bin') < capacity * self.hours * 4:
+            with open(self.path + '.bin', 'ab') as f:                               # grow in place, new rows are zero
+                f.truncate(capacity * self.hours * 4)
+        self.capacity = capacity
+        self.matrix = np.memmap(self.path + '.bin', dtype='<i4', mode=mode, shape=(capacity, self.hours))
+
+    def _row(self, key):
+        '''Row of key, added if new'''
+        if key not in self.rows:
+            if len(self.keys) == self.capacity:
+                self.matrix.flush()
+                self._map(self.capacity * 2)
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+        return self.rows[key]
+
+    def advance(self, hour):
+        '''Move the head to hour, zeroing the columns of the hours it skips over'''
+        if hour <= self.head:
+            return
+        if self.head < 0 or hour - self.head >= self.hours:
+            self.matrix[:] = 0
+        else:
+            cols = np.arange(self.head + 1, hour + 1) % self.hours
+            self.matrix[:, cols] = 0
+        self.head = hour
+
+    def set(self, key, hour, count):
+        '''
+        Set a book's count for an hour; setting (not adding) makes re-queried buckets idempotent.
+        Hours older than the window are ignored.
+        '''
+        with self.lock:
+            self.advance(hour)
+            if hour > self.head - self.hours:
+                row = self._row(key)                                                # may remap the array
+                self.matrix[row, hour % self.hours] = count
+
+    def set_buckets(self, key, buckets):
+        '''Set counts from the 'data' list of a twitter counts response'''
+        for bucket in buckets:
+            self.set(key, to_hour(bucket['start']), bucket['tweet_count'])
+
+    def _cols(self, hours, end=None):
+        '''Ring columns of the trailing hours ending at end (default: head), oldest first'''
+        end = self.head if end is None else end
+        return (np.arange(end - min(hours, self.hours) + 1, end + 1)) % self.hours
+
+    def totals(self, hours=168, end=None):
+        '''Trailing totals for every book as a pandas series indexed by key'''
+        n = len(self.keys)
+        if self.head < 0:
+            return pd.Series(np.zeros(n, dtype='int64'), index=self.keys)
+        return pd.Series(self.matrix[:n][:, self._cols(hours, end)].sum(axis=1, dtype='int64'), index=self.keys)
+
+    def total(self, key, hours=168, end=None):
+        '''Trailing total for one book, or None if it isn't tracked'''
+        if key not in self.rows or self.head < 0:
+            return None
+        return int(self.matrix[self.rows[key], self._cols(hours, end)].sum(dtype='int64'))
+
+    def sparkline(self, key, hours=168):
+        '''Hourly counts for one book, oldest first'''
+        return np.asarray(self.matrix[self.rows[key], self._cols(hours)])
+
+    def top(self, k=100, hours=168):
+        '''Trailing totals of the k most mentioned books, indexed by key'''
+        return self.totals(hours).nlargest(k)
+
+    def subset(self, keys, path):
+        '''Copy the rows of keys into a new matrix at path, e.g. the top books for the app'''
+        sub = HourlyCounts(path, self.hours, create=True)
+        sub.head = self.head
+        for key in keys:
+            if key in self.rows:
+                row = sub._row(key)
+                sub.matrix[row] = self.matrix[self.rows[key]]
+        sub.save()
+        return sub
+
+    def save(self):
+        '''Flush the array and write the metadata'''
+        with self.lock:
+            self.matrix.flush()
+            with open(self.path + '.json.tmp', 'w') as f:
+                json.dump({'hours': self.hours, 'head': self.head, 'capacity': self.capacity, 'keys': self.keys}, f)
+            os.replace(self.path + '.json.tmp', self.path + '.json')
+
+    @classmethod
+    def from_frame(cls, counts_df, path, hours=192):
+        '''
+        Build a matrix from book_counts rows (request_url, start_date, tweet_count) in one vectorized pass.
+        Buckets older than the window ending at the newest bucket are dropped. A bucket is set, not added to,
+        so rows repeated by SQS redelivery (the last one wins) count once, as with set_buckets.
+        '''
+        hc = cls(path, hours, create=True)
+        keys, codes = np.unique(counts_df['request_url'].map(url_query).to_numpy(), return_inverse=True)
+        hour = pd.to_datetime(counts_df['start_date'], utc=True).values.astype('datetime64[h]').astype('int64')
+        keep = hour > hour.max() - hours if len(hour) > 0 else hour > 0
+        hc.keys = keys.tolist()
+        hc.rows = {k: i for i, k in enumerate(hc.keys)}
+        hc._map(max(len(keys), 16), create=True)
+        hc.head = int(hour.max()) if len(hour) > 0 else -1
+        rows, slots = codes[keep], hour[keep] % hours
+        values = counts_df['tweet_count'].to_numpy()[keep].astype('int32')
+        _, last = np.unique((rows * hours + slots)[::-1], return_index=True)       # last row of each bucket
+        last = len(rows) - 1 - last
+        hc.matrix[rows[last], slots[last]] = values[last]
+        hc.save()
+        return hc
+
+_open_matrices = {}
+
+def open_hourly(path):
+    '''Open a matrix once per process and file version'''
+    version = (path, os.stat(path + '.json').st_mtime_ns)
+    if path in _open_matrices and _open_matrices[path][0] == version:
+        return _open_matrices[path][1]
+    hc = HourlyCounts(path)
+    _open_matrices[path] = (version, hc)
+    return hc
@@ -0,0 +1,97 @@
+import math
+import time
+import struct
+import hashlib
+
+def isbn10_is_valid(isbn):
+    '''ISBN-10 checksum: sum of digits weighted 10..1 is divisible by 11; the last digit may be X (10)'''
+    if len(isbn) != 10 or not isbn[:9].isdigit() or not (isbn[9].isdigit() or isbn[9] == 'X'):
+        return False
+    digits = [int(c) for c in isbn[:9]] + [10 if isbn[9] == 'X' else int(isbn[9])]
+    return sum((10 - i) * d for i, d in enumerate(digits)) % 11 == 0
+
+def isbn13_is_valid(isbn):
+    '''ISBN-13 checksum: digits weighted 1, 3, 1, 3, ... sum to a multiple of 10'''
+    if len(isbn) != 13 or not isbn.isdigit() or not isbn.startswith(('978', '979')):
+        return False
+    return sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(isbn)) % 10 == 0
+
+def isbn10_to_isbn13(isbn):
+    '''Convert a valid ISBN-10 to its 978-prefixed ISBN-13'''
+    body = '978' + isbn[:9]
+    check = (10 - sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(body)) % 10) % 10
+    return body + str(check)
+
+def canonical_isbn(isbn):
+    '''
+    Canonical ISBN-13 for an ISBN-10 or ISBN-13 string (hyphens and spaces ignored).
+    Output: ISBN-13 string, or None if the checksum is wrong
+    '''
+    if not isinstance(isbn, str):
+        return None
+    isbn = isbn.replace('-', '').replace(' ', '').upper()
+    if isbn10_is_valid(isbn):
+        return isbn10_to_isbn13(isbn)
+    if isbn13_is_valid(isbn):
+        return isbn
+    return None
+
+class BloomFilter():
+    HEADER = struct.Struct('<8sQQQd')                                               # magic, bits, hashes, count, created
+
+    def __init__(self, capacity=2000000, error_rate=0.001, bits=None, hashes=None, count=0, created=None, data=None):
+        '''
+        Compact set of ISBNs that ISBNDB came back empty for.
+        Membership may be a false positive (at about error_rate at capacity), never a false negative.
+        created is kept so the whole filter can be retired once the re-check interval passes.
+        '''
+        self.bits = bits or int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, int(round(self.bits / capacity * math.log(2))))
+        self.count = count
+        self.created = time.time() if created is None else created
+        self.data = bytearray(data) if data is not None else bytearray((self.bits + 7) // 8)
+
+    def _positions(self, item):
+        '''Double hashing: k positions from two 64-bit halves of one digest'''
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        for p in self._positions(item):
+            self.data[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.data[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    def age_days(self):
+        return (time.time() - self.created) / 86400
+
+    def to_bytes(self):
+        return self.HEADER.pack(b'TBBLOOM1', self.bits, self.hashes, self.count, self.created) + bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, b):
+        magic, bits, hashes, count, created = cls.HEADER.unpack_from(b, 0)
+        if magic != b'TBBLOOM1':
+            raise Exception('Not a bloom filter file')
+        return cls(bits=bits, hashes=hashes, count=count, created=created, data=b[cls.HEADER.size:])
+
+def load_misses(s3, bucket, key, recheck_days=90, capacity=2000000):
+    '''
+    Load the filter of ISBNDB misses from S3.
+    A new, empty filter is started if none exists or the old one is older than recheck_days,
+    so every miss is asked for again once per interval.
+    '''
+    try:
+        misses = BloomFilter.from_bytes(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+        if misses.age_days() < recheck_days:
+            return misses
+    except Exception as e:
+        print(e)
+    return BloomFilter(capacity)
+
+def save_misses(s3, bucket, key, misses):
+    '''Write the filter of ISBNDB misses to S3'''
+    s3.put_object(Bucket=bucket, Key=key, Body=misses.to_bytes())
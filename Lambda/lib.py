@@ -4,10 +4,12 @@ import configparser
 import numpy as np
 import pandas as pd
 import json
-import requests
-from urllib.request import urlopen
+import heapq
 from pandas import json_normalize 
 from datetime import datetime
+from multiprocessing import Process, Pipe
+from transport import transport, isbndb_headers, request_counts
+from metrics import metrics, timed
 
 class SqsQueue():
     def __init__(self, sqs, queue_name):
@@ -67,20 +69,86 @@ def remove_regex(df, col_name, rm_words, rm_chars, code_space=True, add_paren=Tr
         df[col_name] = ['(' + q + ')' for q in df[col_name]]                    # encase string in parentheses
     return df       
     
+def split_frame(df, n):
+    '''Split a dataframe into at most n non-empty chunks, keeping row order and index'''
+    chunks = [chunk for chunk in np.array_split(df, n) if chunk.shape[0] > 0] if n > 1 else []
+    return chunks if len(chunks) > 0 else [df]
+
+def _run_chunk(func, chunk, conn):
+    '''Run func in a child process and send back its result or exception'''
+    try:
+        conn.send((True, func(chunk)))
+    except Exception as e:
+        conn.send((False, e))
+    conn.close()
+
+def map_processes(func, chunks):
+    '''
+    Apply func to each chunk in its own process and return the results in order.
+    Uses Process and Pipe because multiprocessing.Pool and Queue need /dev/shm, which Lambda doesn't have.
+    '''
+    processes, conns = [], []
+    for chunk in chunks:
+        parent_conn, child_conn = Pipe(duplex=False)
+        process = Process(target=_run_chunk, args=(func, chunk, child_conn))
+        process.start()
+        child_conn.close()
+        processes.append(process)
+        conns.append(parent_conn)
+    results = [conn.recv() for conn in conns]                                       # children block until read
+    for process in processes:
+        process.join()
+    for ok, result in results:
+        if not ok:
+            raise result
+    return [result for _, result in results]
+
+def map_chunks(func, chunks):
+    '''Apply func to each chunk, across processes if there is more than one chunk'''
+    if len(chunks) > 1:
+        return map_processes(func, chunks)
+    return [func(chunk) for chunk in chunks]
+
+def stream_top_k(shards, k, column):
+    '''
+    Keep the k rows with the largest values in column across dataframe shards, holding one shard at a time
+    Input: iterable of dataframes, number of rows to keep, column to rank by
+    Output: dataframe of the top k rows in descending order; ties keep the earlier row
+    '''
+    heap = []                                                                       # (value, -sequence, row), smallest on top
+    seq = 0
+    columns = None
+    for shard in shards:
+        if shard.shape[0] == 0:
+            continue
+        columns = shard.columns if columns is None else columns
+        for row in shard.nlargest(k, column, keep='first').to_dict('records'):     # only a shard's top k can survive
+            item = (row[column], -seq, row)
+            seq += 1
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+    rows = [item[2] for item in sorted(heap, key=lambda item: item[:2], reverse=True)]
+    return pd.DataFrame(rows, columns=columns)
+
 def wait_query_success(athena, response):
     '''Check athena query status until it returns "SUCCEEDED"'''
     status=''
     while status != 'SUCCEEDED':
         query_execution = athena.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
         status = query_execution['QueryExecution']['Status']['State']
+        metrics.counter('athena_status_polls')
         if status == 'QUEUED' or status == 'RUNNING':
             print(status)
         if status == 'FAILED' or status == 'CANCELLED':
             print(status + '\n')
             print(query_execution)
             raise Exception(query_execution)
+    metrics.counter('athena_bytes_scanned', query_execution['QueryExecution'].get('Statistics', {}).get('DataScannedInBytes', 0))
     return None
 
+@timed('athena_query')
 def athena_start_query_execution(athena, query, path):
     '''Execute Athena query with given query and output path and wait for success'''
     response = athena.start_query_execution(
@@ -93,7 +161,10 @@ def athena_start_query_execution(athena, query, path):
     return None
 
 def query_builder(query_type, db, table, catalog='', columns=[], bucket='', key='', formatting='', select='', where=''):
-    '''Custom query builder for Athena. Currently supports DROP, CREATE, and UNLOAD'''
+    '''
+    Custom query builder for Athena. Currently supports DROP, CREATE, EXTERNAL (create if not exists), INSERT, and UNLOAD
+    CREATE and INSERT select from {catalog}.{db}, e.g. ccindex.ccindex
+    '''
     if query_type.lower() == 'drop':
         query = f'''DROP TABLE IF EXISTS {db}.{table}'''
     elif query_type.lower() == 'create':
@@ -104,55 +175,120 @@ def query_builder(query_type, db, table, catalog='', columns=[], bucket='', key=
             FROM {catalog}.{db}
         '''
         if where != '': query += f' WHERE {where}'
+    elif query_type.lower() == 'external':
+        query = f'''
+            CREATE EXTERNAL TABLE IF NOT EXISTS {db}.{table} ({columns})
+            STORED AS {formatting}
+            LOCATION 's3://{bucket}/{key}'
+        '''
+    elif query_type.lower() == 'insert':
+        query = f'''
+            INSERT INTO {db}.{table}
+            SELECT {select}
+            FROM {catalog}.{db}
+        '''
+        if where != '': query += f' WHERE {where}'
     elif query_type.lower() == 'unload':
+        where_clause = f' WHERE {where}' if where != '' else ''
         query = f'''
-            UNLOAD (SELECT {select} FROM {table}) 
+            UNLOAD (SELECT {select} FROM {table}{where_clause}) 
             TO 's3://{bucket}/{key}' WITH (format='{formatting}')
         '''
     else:
-        raise('Query type not supported.')
+        raise Exception('Query type not supported.')
     return query
+
+def isbn_extraction_queries(db, table, crawls, bucket, key, unload_key):
+    '''
+    Athena queries that append the ISBNs of new crawls' Amazon book urls to one deduplicated table
+    and unload only those new ISBNs.
+    Only the crawl and subset partitions of the columnar index are read, and only the url and
+    url_host_registered_domain columns. The index is sorted by url_surtkey (reversed host, e.g. "com,amazon)/..."),
+    so each domain's urls are clustered and the min/max statistics of url_host_registered_domain let Athena
+    skip the row groups without amazon.com.
+    Input: athena database, ISBN table name, crawls not yet processed, S3 bucket, table location, unload location
+    Output: list of queries to run in order
+    '''
+    isbn_regex = "'^https://www\\.amazon\\.com/[^/]*/dp/((0|1)[0-9]{8}[0-9X])/.*'"
+    isbn = f'regexp_extract(url, {isbn_regex}, 1)'
+    queries = [query_builder('EXTERNAL', db, table, columns='isbn string, crawl string', bucket=bucket, key=key, formatting='PARQUET')]
+    for crawl in crawls:
+        queries.append(query_builder('INSERT', db, table, catalog=db, select=f'DISTINCT {isbn} AS isbn, crawl',
+            where=f"crawl = '{crawl}' AND subset = 'warc' AND url_host_registered_domain = 'amazon.com'"
+                  f" AND regexp_like(url, {isbn_regex}) AND {isbn} NOT IN (SELECT isbn FROM {db}.{table})"))
+    crawl_list = ', '.join(f"'{crawl}'" for crawl in crawls)
+    queries.append(query_builder('UNLOAD', db, f'{db}.{table}', bucket=bucket, key=unload_key, formatting='JSON',
+        select='isbn', where=f'crawl IN ({crawl_list})'))
+    return queries
     
 def get_latest_common_crawl(collinfo):
     '''Get latest crawl name from Common Crawl'''
-    response = urlopen(collinfo)
-    response_json = json.loads(response.read())
-    return response_json[0]['id']
+    return get_common_crawls(collinfo)[0]
+
+def get_common_crawls(collinfo):
+    '''Get all crawl names from Common Crawl, latest first'''
+    response = transport.get(collinfo)
+    response.raise_for_status()
+    response_json = response.json()
+    return [crawl['id'] for crawl in response_json]
     
+def isbn_chunks(df, chunk_length):
+    '''Split a single-column dataframe of ISBNs into chunks of at most chunk_length-1 rows for ISBNDB'''
+    factor = max(1, int(np.ceil(df.shape[0]/(chunk_length-1))))
+    return np.array_split(df,factor)
+
+def request_ISBNDB_chunk(chunk, request_url, isbn_token):
+    '''Request ISBNDB for book data of one chunk of ISBNs'''
+    print(datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ': currently in isbn loop')
+    data = f'isbns={",".join(chunk.isbn.tolist())}'
+    with metrics.timer('isbndb_request'):
+        response = transport.post(request_url, headers=isbndb_headers(isbn_token), data=data)
+    metrics.counter('isbndb_requests')
+    new_books = json_normalize(response.json(),'data')
+    metrics.counter('isbndb_books', new_books.shape[0])
+    return new_books
+
+@timed()
 def request_ISBNDB(df, request_url, isbn_token, chunk_length):
     '''Chunk single-column dataframe according to chunk_length and request ISBNDB for book data'''
-    factor = df.shape[0]/(chunk_length-1)                                           # chunk
-    isbn_chunks = np.array_split(df,factor)                                         
-    isbn_chunks_joined = [",".join(chunk.isbn.tolist()) for chunk in isbn_chunks]
-    booksdf = pd.DataFrame()                                                        # dataframe to be returned                                                       
-    headers = {'Authorization': isbn_token, 'accept': 'application/json', 'Content-Type': 'application/json'}
-    for chunk in isbn_chunks_joined:
-        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S') + ': currently in isbn loop')
-        data = f'isbns={chunk}'                                                     # request each chunk
-        response = requests.post(request_url, headers=headers, data=data)
-        booksdf = booksdf.append(json_normalize(response.json(),'data'))            # append response to dataframe
+    booksdf = pd.DataFrame()                                                        # dataframe to be returned
+    for chunk in isbn_chunks(df, chunk_length):
+        booksdf = booksdf.append(request_ISBNDB_chunk(chunk, request_url, isbn_token))   # append response to dataframe
     return booksdf
 
+def get_topic_arn(sns, topic_name_with_extension):
+    '''ARN of an SNS topic by name'''
+    topic_arn = None
+    for topic in sns.list_topics()['Topics']:
+        if topic['TopicArn'].split(':')[-1]==topic_name_with_extension:
+            topic_arn = topic['TopicArn']
+            print(topic_arn)
+    if topic_arn is None:
+        raise Exception(f'Please create topic "{topic_name_with_extension}" through the AWS SNS Console.')
+    return topic_arn
+
+def publish_sns_batch(sns, topic_arn, batch):
+    '''Publish one batch of up to 10 messages; returns 1 if any message failed, else 0'''
+    response = sns.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=batch)
+    metrics.counter('sns_publish_batches')
+    metrics.counter('sns_messages', len(batch))
+    metrics.counter('sns_failed_messages', len(response['Failed']))
+    if len(response['Failed'])>0:
+        print(response['Failed'])
+        return 1
+    return 0
+
+@timed()
 def sns_publish(sns, sns_batches, topic_name_with_extension):
     '''
     Batch-publish twitter api queries to an SNS topic
     Input: list of sns message dictionaries in sns publish_batch format
     Output: number of failed messages
     '''
-    topics = sns.list_topics()
+    topic_arn = get_topic_arn(sns, topic_name_with_extension)
     fail_count = 0
-    for topic in topics['Topics']:
-        if topic['TopicArn'].split(':')[-1]==topic_name_with_extension:
-            topic_arn = topic['TopicArn']
-            print(topic_arn)
-    if topic_arn is None:
-        raise Exception('Please create topic "prepbatch.fifo" through the AWS SNS Console.')
-    else:
-        for batch in sns_batches:
-            response = sns.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=batch)
-            if len(response['Failed'])>0:
-                print(response['Failed'])
-                fail_count += 1
+    for batch in sns_batches:
+        fail_count += publish_sns_batch(sns, topic_arn, batch)
     return fail_count
 
 def get_sns_batches(queries):
@@ -167,30 +303,158 @@ def get_sns_batches(queries):
         sns_batches.append(sns_batch)
     return sns_batches
 
+MAX_BATCH_BYTES = 256 * 1024                                                        # publish_batch limit for all entries together
+MAX_MESSAGE_BYTES = MAX_BATCH_BYTES // 10 - 512                                     # 10 full messages fit one publish_batch call
+
+def coalesce_queries(queries, run_id='', max_bytes=MAX_MESSAGE_BYTES):
+    '''
+    Pack many counts urls into each message: {"queries": [{"id": ..., "url": ...}, ...]}, up to max_bytes.
+    Ids are run_id plus the url's position, so a consumer can acknowledge or retry single queries.
+    Output: list of json message bodies
+    '''
+    messages, entries, size = [], [], len('{"queries": []}')
+    for i, url in enumerate(queries):
+        entry = {'id': f'{run_id}{i}', 'url': url}
+        entry_size = len(json.dumps(entry)) + 2                                    # ', ' separator
+        if len(entries) > 0 and size + entry_size > max_bytes:
+            messages.append(json.dumps({'queries': entries}))
+            entries, size = [], len('{"queries": []}')
+        entries.append(entry)
+        size += entry_size
+    if len(entries) > 0:
+        messages.append(json.dumps({'queries': entries}))
+    return messages
+
+def get_coalesced_sns_batches(queries, run_id=''):
+    '''
+    Like get_sns_batches, with many queries per message (coalesce_queries);
+    a batch holds at most 10 messages and MAX_BATCH_BYTES in total.
+    '''
+    sns_batches, batch, size = [], [], 0
+    for i, message in enumerate(coalesce_queries(queries, run_id)):
+        if len(batch) == 10 or (len(batch) > 0 and size + len(message) > MAX_BATCH_BYTES):
+            sns_batches.append(batch)
+            batch, size = [], 0
+        batch.append({'Id': str(len(batch)), 'Message': message, 'MessageGroupId': str(i)})
+        size += len(message)
+    if len(batch) > 0:
+        sns_batches.append(batch)
+    return sns_batches
+
+def parse_query_message(body):
+    '''
+    Queries of a prepbatch message, for consumers: a coalesced json message, or a single url as sent by get_sns_batches.
+    SQS records of an SNS subscription without raw delivery are unwrapped from the SNS envelope first.
+    Output: list of {'id': ..., 'url': ...}; a single url gets its own url as id
+    '''
+    if body.startswith('{'):
+        message = json.loads(body)
+        if 'queries' in message:
+            return message['queries']
+        if message.get('Type') == 'Notification':                                   # SNS envelope
+            return parse_query_message(message['Message'])
+    return [{'id': body, 'url': body}]
+
+def handle_query_messages(records, handle, retry=None):
+    '''
+    Process the SQS records of an SQS-triggered Lambda, one message at a time as a unit.
+    handle(url) is called for every query; a query that raises or returns None is a partial failure.
+    None is what request_tweet_counts returns on 429, and with dozens of queries per message rate limiting
+    is the normal case, so a rate-limited query is retried rather than acknowledged.
+    The failed queries of a message are passed to retry(queries), e.g. to republish them as a smaller message,
+    and the message is acknowledged. Without retry, or if retry raises, the message is reported in
+    batchItemFailures so SQS redelivers it (with ReportBatchItemFailures on the event source mapping);
+    queries that succeeded are then served from the counts cache.
+    Output: {query id: result}, {'batchItemFailures': [...]}
+    '''
+    results, failures = {}, []
+    for record in records:
+        failed = []
+        for query in parse_query_message(record['body']):
+            try:
+                result = handle(query['url'])
+            except Exception as e:
+                print(f"{query['id']}: {e}")
+                failed.append(query)
+                continue
+            if result is None:
+                metrics.counter('queries_rate_limited')
+                failed.append(query)
+            else:
+                results[query['id']] = result
+        metrics.counter('queries_failed', len(failed))
+        if len(failed) == 0:
+            continue
+        try:
+            if retry is None:
+                raise Exception(f'{len(failed)} queries failed')
+            retry(failed)
+        except Exception as e:
+            print(e)
+            failures.append({'itemIdentifier': record['messageId']})
+    return results, {'batchItemFailures': failures}
+
+class QueryPacker():
+    PREFIX = 'https://api.twitter.com/2/tweets/counts/recent?query='
+    SEPARATOR = '%20OR%20'
+
+    def __init__(self, max_q=512):
+        '''
+        Incrementally combine book queries with "or" logic, twitter-style.
+        add() returns a request url as soon as the next query doesn't fit, so requests can be sent while queries still arrive.
+        '''
+        self.max_q = max_q                                                          # Max query length according to Twitter
+        self.query = ''
+
+    def add(self, q):
+        '''Add a book query; returns a list with the completed request url, if any'''
+        if len(q) >= self.max_q:                                                    # single query string > max query length
+            return []
+        if self.query == '':
+            self.query = q
+            return []
+        if len(self.query + self.SEPARATOR + q) < self.max_q:                       # Keep query under max length
+            self.query = self.query + self.SEPARATOR + q
+            return []
+        full, self.query = self.PREFIX + self.query, q
+        return [full]
+
+    def flush(self):
+        '''Request url of the queries added since the last completed one, if any'''
+        full, self.query = self.query, ''
+        return [self.PREFIX + full] if full != '' else []
+
+@timed()
 def build_tweet_counts_query(q_list):
     '''
     Take a list of queries and combine them with "or" logic, twitter-style
     Input: q_list: list or pandas series of strings
-    Output: df: pandas dataframe with a column of queries
-    '''
-    max_q = 512  # Max query length according to Twitter
-    q_list = [q for q in q_list if len(q)<max_q]  # Remove if single query string > max query length
-    query_list = [] 
-
-    # Build queries
-    iter_q = iter(q_list)
-    for q in iter_q:
-        query = ''
-        while (len(query + "%20OR%20" + q) < max_q):  # Keep query under max length
-            if query == '': query += q
-            else: query = query + '%20OR%20' + q  # Build query with "OR" logic
-            try: q = next(iter_q)
-            except: break  # Generator exhausted  
-        query = "https://api.twitter.com/2/tweets/counts/recent?query=" + query
-        query_list.append(query)
+    Output: list of request urls
+    '''
+    packer = QueryPacker()
+    query_list = []
+    for q in q_list:
+        query_list += packer.add(q)
+    query_list += packer.flush()
 
+    metrics.counter('twitter_counts_queries', len(query_list))
     return query_list 
 
+def request_tweet_counts(url, twitter_bearer, cache=None):
+    '''
+    Request tweet counts for a twitter counts url, serving duplicate and redelivered requests from cache
+    Input: counts url, bearer token, optional cache.CountsCache
+    Output: json response, or None if rate-limited
+    '''
+    def fetch(url):
+        return request_counts(url, twitter_bearer)
+    if cache is None:
+        return fetch(url)
+    hits = cache.hits
+    response = cache.get_or_fetch(url, fetch)
+    metrics.counter('twitter_cache_hits', cache.hits - hits)
+    return response
+
 def explode_query(query_list):
     '''Get individual book queries from bookset queries'''
     exploded_list=[]
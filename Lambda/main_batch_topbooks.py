@@ -4,12 +4,19 @@ import awswrangler as wr
 import datetime
 import boto3
 from lib import *
+from catalog import write_catalog
+from hourly import HourlyCounts
+from works import assign_works
+from schedule import update_history, refresh_run, RUN_KEY
+from metrics import metrics
 
 def lambda_handler(event, context):
     '''
     Send alert if prebatch and batchbook queues are not empty.
     Select relevant data to be served and copy to main directory.
     '''
+    metrics.configure(function=getattr(context, 'function_name', 'main_batch_topbooks'))
+    
     # Send alert if prebatch and batchbook queues are not empty
     sqs = boto3.client('sqs')
     prepbatch = SqsQueue(sqs=sqs, queue_name='prepbatch.fifo')
@@ -28,26 +35,122 @@ def lambda_handler(event, context):
         )
         
     # read new set of counts to athena
-    copy_to_csv()
+    with metrics.timer('copy_to_csv'):
+        counts_df = copy_to_csv()
     glue = boto3.client('glue')
     glue_response = glue.start_crawler(Name='book_counts') 
     
-    # Combine most-mentioned books fact data with the book dimension data
-    top_df = wr.s3.read_json(path='s3://warcbooks/data/extracted/twitter/topbooks/most_recent',dtype=False)
+    # Per-book mention history for the refresh scheduler in twitterbooks
+    history_path = 's3://warcbooks/data/extracted/twitter/history/history.json'
+    try:
+        history_df = wr.s3.read_json(history_path, dtype=False)
+    except Exception as e:
+        print(e)
+        history_df = pd.DataFrame(columns=['query'])
+    wr.s3.to_json(df=update_history(history_df, counts_df, scheduled_run('warcbooks')), path=history_path)
+    
+    # Dense books x hours counts for rolling windows
+    hourly = HourlyCounts.from_frame(counts_df, '/tmp/hourly')
+    
+    # Book dimension data
     isbn_df = wr.s3.read_json(path='s3://warcbooks/data/transformed/isbn/cur_version', dtype=False)
     isbn_df = isbn_df.drop_duplicates()
+    isbn_df = assign_works(isbn_df)                                                 # earliest publication year of each work
     wr.s3.to_json(df=isbn_df, path='s3://warcbooks/data/main/batch/isbn/cur_version/isbn.json')
-    top_df['query']=top_df['request_url'].str.replace('https:\/\/api.twitter.com\/2\/tweets\/counts\/recent\?query=','',regex=True)
-    joined_df = top_df.set_index('query').join(isbn_df.set_index('query'))
-    joined_df = joined_df[pd.notna(joined_df['title'])]
-    joined_df = joined_df.sort_values(by=['total_count'], ascending=False).reset_index().drop(columns=['index'])
-    wr.s3.to_json(df=joined_df, path='s3://warcbooks/data/transformed/topbooks/all', dataset=True)
-    wr.s3.to_json(df=joined_df, path='s3://warcbooks/data/transformed/topbooks/most_recent/topbooks.json')
     
-    # Select relevant data to be served and copy to main directory
-    joined_df = joined_df[['title','title_short', 'authors','date_published','total_count','query']].reset_index()
+    # Memory-mapped catalog of every tracked book with its mentions, for lookups and prefix search in the app
+    write_catalog(isbn_df.assign(mentions=isbn_df['query'].map(hourly.totals())), '/tmp/catalog.bin')
+    wr.s3.upload(local_file='/tmp/catalog.bin', path='s3://warcbooks/data/main/batch/catalog/cur_version/catalog.bin')
+    
+    # Update the book's publication year if an earlier edition exists, using an external list
+    # (The external list is downloaded from https://thegreatestbooks.org/lists/details -> Misc
+    #  and uploaded to s3 manually; only needs to be done once.)
+    ext_df = wr.s3.read_json('s3://warcbooks/data/extracted/bestbooks/bestbooks.json',dtype=False)
+    ext_df = ext_df.rename(columns={'title':'title_temp'})
+    ext_df['title_temp']=ext_df['title_temp'].str.replace('\W',' ',regex=True)
+    
+    # Combine most-mentioned books fact data with the book dimension data
+    # Count shards are streamed through a bounded heap; only the survivors are joined for the app's ranking.
+    # Dedup and exclusions below may drop survivors, so keep a margin and widen it if fewer than 100 remain.
+    # The first pass also joins every shard and appends it to the archive of all counted books as it streams;
+    # the archive isn't held in memory or sorted, so most_recent is a dataset directory of one file per shard.
+    shards = wr.s3.list_objects('s3://warcbooks/data/extracted/twitter/topbooks/most_recent')
+    wr.s3.delete_objects('s3://warcbooks/data/transformed/topbooks/most_recent/')
+    archived = 0
+    def read_shards():
+        nonlocal archived
+        for shard in shards:
+            shard_df = wr.s3.read_json(path=shard, dtype=False)
+            if archived < len(shards):
+                books_df = join_books(shard_df, isbn_df)
+                wr.s3.to_json(df=books_df, path='s3://warcbooks/data/transformed/topbooks/all', dataset=True)
+                wr.s3.to_json(df=books_df, path='s3://warcbooks/data/transformed/topbooks/most_recent/', dataset=True)
+                archived += 1
+            yield shard_df
+    margin = 5
+    while True:
+        metrics.counter('top_k_passes')
+        with metrics.timer('stream_top_k'):
+            top_df = stream_top_k(read_shards(), 100*margin, 'total_count')
+        joined_df = join_books(top_df, isbn_df)
+        with metrics.timer('select_topbooks'):
+            jdf = select_topbooks(joined_df, ext_df, 100)
+        if jdf.shape[0] >= 100 or top_df.shape[0] < 100*margin:            # enough books, or every row was kept
+            break
+        margin *= 4
+    
+    # Hourly counts of the top books for the app's speed layer
+    hourly.subset(jdf['query'], '/tmp/hourly_top')
+    for ext in ['bin','json']:
+        wr.s3.upload(local_file=f'/tmp/hourly.{ext}', path=f's3://warcbooks/data/main/batch/hourly/cur_version/counts.{ext}')
+        wr.s3.upload(local_file=f'/tmp/hourly_top.{ext}', path=f's3://warcbooks/data/main/batch/hourly/most_recent/topbooks.{ext}')
+    
+    # Write to main most_recent
+    wr.s3.to_json(df=jdf, path='s3://warcbooks/data/main/batch/topbooks/most_recent/topbooks.json')
+    
+    # Write to main all
+    datestr = datetime.now().strftime('%Y%m%d%H%M%S')
+    wr.s3.to_json(df=jdf, path=f's3://warcbooks/data/main/batch/topbooks/all/{datestr}.json')
+    
+    metrics.flush()
+    return f'{jdf.shape[0]} records were written to main/batch/topbook directories.'
+    
+def scheduled_run(bucket):
+    '''
+    Run number twitterbooks scheduled these counts with, so the history matches the scheduler
+    even when this function runs in the following week; the current run number if it wasn't saved
+    '''
+    try:
+        return json.loads(boto3.client('s3').get_object(Bucket=bucket, Key=RUN_KEY)['Body'].read())['run']
+    except Exception as e:
+        print(e)
+        return refresh_run()
+
+def join_books(counts_df, isbn_df):
+    '''
+    Join counts rows (request_url, total_count) with the book dimension data on query
+    Output: dataframe of counted books with their dimension data, most mentioned first
+    '''
+    counts_df = counts_df.copy()
+    counts_df['query']=counts_df['request_url'].str.replace('https:\/\/api.twitter.com\/2\/tweets\/counts\/recent\?query=','',regex=True)
+    dim_df = isbn_df[isbn_df['query'].isin(counts_df['query'])]
+    joined_df = counts_df.set_index('query').join(dim_df.set_index('query'))
+    joined_df = joined_df[pd.notna(joined_df['title'])]
+    return joined_df.sort_values(by=['total_count'], ascending=False).reset_index().drop(columns=['index'])
+
+def select_topbooks(joined_df, ext_df, n=100):
+    '''
+    Clean up, deduplicate and rank the most-mentioned books for the app
+    Input: counts joined with book dimension data (with work_year), external list of earliest publication years, number of books
+    Output: dataframe of the top n books
+    '''
+    # Select relevant data to be served
+    joined_df = joined_df[['title','title_short', 'authors','date_published','work_year','total_count','query']].reset_index()
     joined_df.index = joined_df.index+1
     joined_df['date_published']=joined_df['date_published'].str[:4]
+    work_year = joined_df['work_year'].dropna().astype(int).astype(str)                # earliest edition in the catalog
+    joined_df['date_published']=work_year.combine_first(joined_df['date_published'])
+    joined_df = joined_df.drop(columns=['work_year'])
     joined_df['author_list']=joined_df['authors'].str.split(', ')
     authors=[]
     for name in joined_df['author_list']:
@@ -60,12 +163,7 @@ def lambda_handler(event, context):
     joined_df = joined_df.drop(columns=['author_list','authors'])
     temp_df = joined_df.rename(columns={'date_published':'year','total_count':'mentions'})
     
-    # Update the book's publication year if an earlier edition exists, using an external list
-    # (The external list is downloaded from https://thegreatestbooks.org/lists/details -> Misc
-    #  and uploaded to s3 manually; only needs to be done once.)
-    ext_df = wr.s3.read_json('s3://warcbooks/data/extracted/bestbooks/bestbooks.json',dtype=False)
-    ext_df = ext_df.rename(columns={'title':'title_temp'})
-    ext_df['title_temp']=ext_df['title_temp'].str.replace('\W',' ',regex=True)
+    # Update the book's publication year if an earlier edition exists, using the external list
     temp_df['title_temp']=temp_df['title_short'].str.replace('\W',' ',regex=True)
     jdf = temp_df.set_index(['title_temp','author(s)']).join(ext_df.set_index(['title_temp','author(s)']), lsuffix='_left', rsuffix='_right')
     jdf['year'] = jdf['year_right'].combine_first(jdf['year_left'])
@@ -89,26 +187,21 @@ def lambda_handler(event, context):
     jdf = jdf.drop_duplicates(subset=['shortened_title','A1']).reset_index(drop=True)
     print(jdf[jdf['shortened_title'].str.contains('Jane Eyre')])
     jdf = jdf.drop(columns=['A0','A1','A2'])
-    jdf = jdf.nlargest(100,'mentions').reset_index().drop(columns=['index'])
+    jdf = jdf.nlargest(n,'mentions').reset_index().drop(columns=['index'])
     jdf.index= jdf.index+1
     
-    # Write to main most_recent
-    wr.s3.to_json(df=jdf, path='s3://warcbooks/data/main/batch/topbooks/most_recent/topbooks.json')
-    
-    # Write to main all
-    datestr = datetime.now().strftime('%Y%m%d%H%M%S')
-    wr.s3.to_json(df=jdf, path=f's3://warcbooks/data/main/batch/topbooks/all/{datestr}.json')
-    
-    return f'{jdf.shape[0]} records were written to main/batch/topbook directories.'
-    
+    return jdf
+
 def copy_to_csv():
     '''
     Copies json files to csv for athena glue crawler
+    Output: all hourly count rows read from json
     '''
-    counts_df = wr.s3.read_json(path='s3://warcbooks/data/extracted/twitter/book_counts/most_recent/',dtype=False)\
-                .sort_values('start_date',ascending=False)\
+    raw_df = wr.s3.read_json(path='s3://warcbooks/data/extracted/twitter/book_counts/most_recent/',dtype=False)
+    counts_df = raw_df.sort_values('start_date',ascending=False)\
                 .drop_duplicates(subset='request_url',keep='first')\
                 .reset_index(drop=True)\
                 .set_index(['start_date','end_date','request_url'])
     datestr = datetime.now().strftime('%Y%m%d%H%M%S')
-    wr.s3.to_csv(df=counts_df, path=f's3://warcbooks/data/extracted/twitter/book_counts/csv/batch_copied_from_json.csv')
\ No newline at end of file
+    wr.s3.to_csv(df=counts_df, path=f's3://warcbooks/data/extracted/twitter/book_counts/csv/batch_copied_from_json.csv')
+    return raw_df
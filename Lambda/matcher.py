@@ -0,0 +1,51 @@
+import re
+import json
+from wordindex import query_words, RarestWordIndex
+
+TOKEN = re.compile(r'\w+')
+
+def tweet_words(text):
+    '''Lowercase word set of a tweet, split like the query words built by transform_isbn'''
+    return set(TOKEN.findall(text.lower()))
+
+class StreamMatcher():
+    def __init__(self, queries):
+        '''
+        Match a stream of tweets against every book query, and-ing the words of each query.
+        A query matches a tweet when its word set is contained in the tweet's, so the queries are kept in a
+        RarestWordIndex and a tweet is only checked against the few queries filed under its own words.
+        Input: list or pandas series of transform_isbn queries, e.g. "(virginia%20waves%20woolf)"
+        '''
+        self.queries = list(queries)
+        self.wordsets = [query_words(q) for q in self.queries]
+        self.index = RarestWordIndex(self.wordsets)
+        self.counts = [0] * len(self.queries)
+        self.tweets = 0
+
+    def match(self, text):
+        '''Positions of the queries matching a tweet'''
+        return self.index.contained_in(tweet_words(text))
+
+    def consume(self, texts):
+        '''
+        Update running per-book counts with a batch of tweet texts.
+        Output: number of book mentions found in the batch
+        '''
+        mentions = 0
+        for text in texts:
+            matched = self.match(text)
+            for i in matched:
+                self.counts[i] += 1
+            mentions += len(matched)
+            self.tweets += 1
+        return mentions
+
+    def consume_stream(self, lines):
+        '''Update counts from json lines of Twitter's volume stream ({"data": {"text": ...}})'''
+        texts = (json.loads(line)['data']['text'] for line in lines if line)
+        return self.consume(texts)
+
+    def top(self, k=100):
+        '''Most mentioned books so far as (query, count) pairs'''
+        ranked = sorted(range(len(self.queries)), key=lambda i: -self.counts[i])[:k]
+        return [(self.queries[i], self.counts[i]) for i in ranked if self.counts[i] > 0]
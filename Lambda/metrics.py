@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+class Metrics():
+    def __init__(self, namespace='Twitterbooks', function='', path=None, stdout=True):
+        '''
+        Counters, timers and histograms, emitted in CloudWatch embedded metric format (EMF).
+        Lines printed from a Lambda function become CloudWatch metrics without any API calls;
+        path (or the METRICS_FILE environment variable) also appends them to a local file.
+        '''
+        self.namespace = namespace
+        self.function = function
+        self.path = path
+        self.stdout = stdout
+        self.lock = threading.Lock()
+        self.values = {}                                                            # name -> (unit, list of values)
+
+    def configure(self, function=None, path=None, stdout=None):
+        '''Set the Function dimension and sinks, e.g. from a Lambda context'''
+        if function is not None: self.function = function
+        if path is not None: self.path = path
+        if stdout is not None: self.stdout = stdout
+
+    def record(self, name, value, unit):
+        with self.lock:
+            self.values.setdefault(name, (unit, []))[1].append(value)
+
+    def counter(self, name, value=1):
+        '''Add to a counter; counters are summed when flushed'''
+        with self.lock:
+            unit, values = self.values.setdefault(name, ('Count', [0]))
+            values[0] += value
+
+    def histogram(self, name, value, unit='None'):
+        '''Record one observation, e.g. a batch size'''
+        self.record(name, value, unit)
+
+    @contextmanager
+    def timer(self, name):
+        '''Time a block in milliseconds'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000, 'Milliseconds')
+
+    def timed(self, name=None):
+        '''Decorator timing every call of a function'''
+        def decorator(func):
+            metric = name or func.__name__
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(metric):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def records(self):
+        '''EMF records of everything recorded since the last flush; EMF allows 100 values per metric'''
+        with self.lock:
+            values, self.values = self.values, {}
+        records = []
+        for start in range(0, max([len(v) for _, v in values.values()] + [0]), 100):
+            record = {'_aws': {'Timestamp': int(time.time() * 1000), 'CloudWatchMetrics': [{
+                'Namespace': self.namespace, 'Dimensions': [['Function']], 'Metrics': []}]},
+                'Function': self.function}
+            for name, (unit, v) in values.items():
+                if start < len(v):
+                    record['_aws']['CloudWatchMetrics'][0]['Metrics'].append({'Name': name, 'Unit': unit})
+                    record[name] = v[start:start + 100]
+            records.append(record)
+        return records
+
+    def discard(self):
+        '''Drop everything recorded since the last flush, e.g. after a dry run'''
+        with self.lock:
+            self.values = {}
+
+    def flush(self):
+        '''Emit recorded metrics to stdout and/or the local file sink'''
+        path = self.path or os.environ.get('METRICS_FILE')
+        lines = [json.dumps(record) for record in self.records()]
+        if self.stdout:
+            for line in lines:
+                sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+        if path and len(lines) > 0:
+            with open(path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+        return len(lines)
+
+# shared by the lambda functions, lib.py and the app
+metrics = Metrics()
+timed = metrics.timed
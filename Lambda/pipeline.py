@@ -0,0 +1,140 @@
+import time
+import queue
+import threading
+import pandas as pd
+from lib import QueryPacker, get_sns_batches, parse_query_message
+from metrics import metrics
+
+_DONE = object()
+
+class _Stopped(Exception):
+    pass
+
+def _put(q, item, stop):
+    '''Put into a bounded queue, blocking while it's full (back-pressure) unless the pipeline stops'''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+    raise _Stopped()
+
+def _drain(q, stop):
+    '''Iterate a queue until the upstream stage is done or the pipeline stops'''
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+def run_pipeline(source, stages, maxsize=2):
+    '''
+    Run generator stages concurrently, each in its own thread, connected by bounded queues.
+    A stage takes an iterator of its inputs and yields its outputs; a full queue blocks the stage feeding it,
+    so a slow stage holds at most maxsize items of each upstream stage in memory.
+    The first exception in any stage stops the pipeline and is raised here.
+    Input: iterable of inputs to the first stage, list of stage functions, queue size
+    Output: list of the last stage's outputs
+    '''
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize) for _ in stages]
+
+    def run(stage, inputs, out):
+        try:
+            for item in stage(inputs):
+                _put(out, item, stop)
+        except _Stopped:
+            pass
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            try:
+                _put(out, _DONE, stop)
+            except _Stopped:                                                        # downstream stops by itself
+                pass
+
+    threads = []
+    for i, stage in enumerate(stages):
+        inputs = iter(source) if i == 0 else _drain(queues[i - 1], stop)
+        threads.append(threading.Thread(target=run, args=(stage, inputs, queues[i]), daemon=True))
+    for thread in threads:
+        thread.start()
+    outputs = []
+    for item in _drain(queues[-1], stop):
+        outputs.append(item)
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return outputs
+
+def batch_queries(batch):
+    '''Book queries in the messages of an SNS batch, in either message format (lib.parse_query_message)'''
+    queries = []
+    for entry in batch:
+        for query in parse_query_message(entry['Message']):
+            queries += query['url'][len(QueryPacker.PREFIX):].split(QueryPacker.SEPARATOR)
+    return queries
+
+def stream_books(chunks, fetch, transform, publish, select=None, make_batches=None, maxsize=2):
+    '''
+    Streaming mode of the ISBNDB -> transform -> pack -> publish stages of twitterbooks:
+    each ISBNDB chunk is transformed, packed and published as soon as it arrives,
+    so the Twitter stage starts with the first chunk instead of after the last.
+    Queries published earlier in the stream are not published again.
+    A batch's queries count as published only once publish() returns no failures,
+    so the queries of failed batches are left to the batch publish after the stream.
+    Input: ISBN chunks, fetch(chunk) -> ISBNDB dataframe, transform(dataframe) -> transform_isbn dataframe,
+           publish(sns batch) -> number of failed batches,
+           select(transformed dataframe) -> the rows to publish (default: all),
+           make_batches(urls, chunk number) -> sns batches (default: lib.get_sns_batches)
+    Output: all fetched ISBNDB data, set of published book queries, failed batch count
+    '''
+    select = select or (lambda tdf: tdf)
+    make_batches = make_batches or (lambda urls, i: get_sns_batches(urls))
+    books = []
+    seen = set()
+    published = set()
+    start = time.perf_counter()
+
+    def fetch_stage(chunks):
+        for chunk in chunks:
+            booksdf = fetch(chunk)
+            books.append(booksdf)
+            yield booksdf
+
+    def transform_stage(frames):
+        for booksdf in frames:
+            if booksdf.shape[0] == 0:
+                continue
+            tdf = transform(booksdf)
+            tdf = select(tdf[~tdf['query'].isin(seen)].drop_duplicates(subset='query'))
+            seen.update(tdf['query'])
+            yield list(tdf['query'])
+
+    def pack_stage(query_lists):
+        packer = QueryPacker()
+        i = 0
+        for i, queries in enumerate(query_lists):
+            urls = [url for q in queries for url in packer.add(q)]
+            yield from make_batches(urls, i)
+        yield from make_batches(packer.flush(), i + 1)
+
+    def publish_stage(batches):
+        for i, batch in enumerate(batches):
+            if i == 0:
+                metrics.histogram('stream_first_publish', (time.perf_counter() - start) * 1000, 'Milliseconds')
+            failed = publish(batch)
+            if failed == 0:
+                published.update(batch_queries(batch))
+            yield failed
+
+    fail_count = sum(run_pipeline(chunks, [fetch_stage, transform_stage, pack_stage, publish_stage], maxsize))
+    booksdf = pd.concat(books) if len(books) > 0 else pd.DataFrame()
+    return booksdf, published, fail_count
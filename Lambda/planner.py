@@ -0,0 +1,130 @@
+import json
+import math
+from lib import build_tweet_counts_query, get_sns_batches, get_coalesced_sns_batches, explode_query
+from twitterbooks import select_queries
+
+# Limits and list prices the estimates are based on; adjust them to the account's plans
+RATES = {
+    'twitter_requests_per_window': 300,                                             # counts/recent, per bearer token
+    'twitter_window_seconds': 900,
+    'isbndb_requests_per_second': 1.0,
+    'isbndb_books_per_request': 999,
+}
+PRICES = {                                                                          # USD
+    'athena_per_tb': 5.0,
+    'sns_per_million': 0.50,
+    'sqs_per_million': 0.50,                                                        # FIFO; send, receive and delete each count
+    'twitter_per_request': 0.0,
+    'isbndb_per_request': 0.0,
+}
+
+def zero_rate_from_counts(counts_df):
+    '''Share of packed requests (more than one book) that came back with 0 mentions, or None without counts'''
+    if counts_df is None or counts_df.shape[0] == 0:
+        return None
+    totals = counts_df.groupby('request_url')['tweet_count'].sum()
+    packed = totals[totals.index.str.contains('%20OR%20')]
+    return float((packed == 0).mean()) if packed.shape[0] > 0 else None
+
+def nonzero_probabilities(urls, history_df, zero_rate):
+    '''
+    Chance that each packed request comes back non-zero and is exploded into book requests.
+    A request with a book mentioned when last counted is taken as non-zero, one whose books were all at zero as zero;
+    requests with books not counted before fall back to the historical zero rate.
+    '''
+    mentions = history_df.set_index('query')['mentions'] if history_df.shape[0] > 0 else {}
+    probabilities = []
+    for url in urls:
+        books = url.split('query=')[1].split('%20OR%20')
+        known = [mentions[q] for q in books if q in mentions]
+        if any(m > 0 for m in known):
+            probabilities.append(1.0)
+        elif len(known) == len(books):
+            probabilities.append(0.0)
+        else:
+            probabilities.append(1.0 - zero_rate)
+    return probabilities
+
+def plan_run(tdf, counts_df, history_df, run, new_isbns=0, athena_tb=0.0, tokens=1, explode_limit=None,
+             zero_rate=None, rates=RATES, prices=PRICES):
+    '''
+    Estimate a weekly run without calling any API: the pure stages (select_queries, build_tweet_counts_query,
+    get_sns_batches, explode_query) run locally on the transformed table, and historical zero rates
+    predict how many packed requests get exploded into book requests.
+    Input: deduplicated transformed table, last run's book_counts (or None), mention history, refresh run number,
+           expected new ISBNs for ISBNDB, expected Athena terabytes scanned, bearer tokens, at most how many
+           non-zero packed requests are exploded (None: all), zero rate to use instead of the historical one
+    Output: dict plan report
+    '''
+    selected, _, subsume_report, schedule_report = select_queries(tdf, counts_df, history_df, run)
+    packed = build_tweet_counts_query(selected['query'])
+    sns_batches = get_sns_batches(packed)
+    coalesced_batches = get_coalesced_sns_batches(packed)
+    historical_zero_rate = zero_rate_from_counts(counts_df)
+    if zero_rate is None:
+        zero_rate = historical_zero_rate if historical_zero_rate is not None else 0.5
+    p = nonzero_probabilities(packed, history_df, zero_rate)
+    books = [len(explode_query([url])) for url in packed]
+    ranked = sorted(zip(p, books), reverse=True)[:explode_limit]
+    exploded = sum(pi * n for pi, n in ranked)
+
+    twitter_requests = len(packed) + exploded
+    twitter_seconds = twitter_requests / (tokens * rates['twitter_requests_per_window']) * rates['twitter_window_seconds']
+    isbndb_requests = math.ceil(new_isbns / rates['isbndb_books_per_request'])
+    isbndb_seconds = isbndb_requests / rates['isbndb_requests_per_second']
+    sqs_requests = 3 * (len(packed) + exploded)
+    cost = {
+        'athena': athena_tb * prices['athena_per_tb'],
+        'sns': len(packed) / 1e6 * prices['sns_per_million'],
+        'sqs': sqs_requests / 1e6 * prices['sqs_per_million'],
+        'twitter': twitter_requests * prices['twitter_per_request'],
+        'isbndb': isbndb_requests * prices['isbndb_per_request'],
+    }
+    return {
+        'run': run,
+        'books': int(tdf.shape[0]),
+        'books_selected': int(selected.shape[0]),
+        'packed_requests': len(packed),
+        'books_per_packed_request': selected.shape[0] / len(packed) if len(packed) > 0 else 0.0,
+        'sns_messages': len(packed),
+        'sns_batches': len(sns_batches),
+        'coalesced_sns_messages': sum(len(batch) for batch in coalesced_batches),
+        'coalesced_sns_batches': len(coalesced_batches),
+        'zero_rate': zero_rate,
+        'historical_zero_rate': historical_zero_rate,
+        'expected_nonzero_requests': round(sum(pi for pi, _ in ranked), 1),
+        'expected_book_requests': round(exploded, 1),
+        'twitter_requests': round(twitter_requests, 1),
+        'tokens': tokens,
+        'twitter_hours': round(twitter_seconds / 3600, 2),
+        'isbndb_requests': isbndb_requests,
+        'isbndb_hours': round(isbndb_seconds / 3600, 2),
+        'athena_tb': athena_tb,
+        'cost_usd': {k: round(v, 4) for k, v in cost.items()},
+        'total_cost_usd': round(sum(cost.values()), 4),
+        'subsumption': subsume_report,
+        'schedule': schedule_report,
+        'rates': rates,
+        'prices': prices,
+    }
+
+def write_plan(plan, path):
+    '''Write a plan report as json'''
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=2)
+
+if __name__ == '__main__':
+    # Plan the next run from the data on S3 and write plan.json: python planner.py [tokens] [new_isbns] [athena_tb]
+    import sys
+    import awswrangler as wr
+    from schedule import refresh_run
+    from twitterbooks import read_counts_and_history
+    tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    new_isbns = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    athena_tb = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    tdf = wr.s3.read_json('s3://warcbooks/data/transformed/isbn/cur_version', dtype=False)
+    tdf = tdf.drop_duplicates(subset='query').drop(columns=['index']).reset_index(drop=True)
+    counts_df, history_df = read_counts_and_history('warcbooks')
+    plan = plan_run(tdf, counts_df, history_df, refresh_run(), new_isbns, athena_tb, tokens)
+    write_plan(plan, 'plan.json')
+    print(json.dumps(plan, indent=2))
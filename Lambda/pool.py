@@ -0,0 +1,158 @@
+import time
+import zlib
+import queue
+import threading
+import pandas as pd
+from metrics import metrics
+from transport import fetch_counts
+
+class TokenState():
+    def __init__(self, token):
+        '''Rate-limit state of one bearer token, from the x-rate-limit headers of its last response'''
+        self.token = token
+        self.remaining = None                                                       # unknown until the first response
+        self.reset = 0.0                                                            # epoch seconds the window resets at
+        self.requests = 0
+        self.throttled = 0
+
+    def update(self, headers):
+        if 'x-rate-limit-remaining' in headers:
+            self.remaining = int(headers['x-rate-limit-remaining'])
+        if 'x-rate-limit-reset' in headers:
+            self.reset = float(headers['x-rate-limit-reset'])
+
+    def wait(self, now):
+        '''Seconds to wait before this token may send another request'''
+        if self.remaining == 0 and self.reset > now:
+            return self.reset - now
+        return 0.0
+
+class CredentialPool():
+    def __init__(self, tokens, fetch=fetch_counts, cache=None, clock=time.time):
+        '''
+        Spread counts requests over several bearer tokens, each with its own rate limit.
+        Every token has a worker thread taking urls from one shared queue. A token that runs out of requests
+        waits for its window to reset without holding any work, so the other tokens take over its share;
+        a request that comes back 429 is put back in the queue for whichever token is free first.
+        Input: bearer tokens, fetch(url, token) -> (status, json, headers), optional cache.CountsCache
+        '''
+        self.states = [TokenState(token) for token in tokens]
+        self.fetch = fetch
+        self.cache = cache
+        self.clock = clock
+
+    def _worker(self, state, work, results, remaining, lock, errors):
+        while True:
+            with lock:
+                if remaining[0] == 0 or len(errors) > 0:
+                    return
+            wait = state.wait(self.clock())
+            if wait > 0:
+                time.sleep(min(wait, 1.0))                                          # recheck: work may run out meanwhile
+                continue
+            try:
+                i, url = work.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            try:
+                status, body, headers = self.fetch(url, state.token)
+            except Exception as e:
+                errors.append(e)
+                return
+            state.requests += 1
+            state.update(headers)
+            metrics.counter('twitter_requests')
+            if status == 429:
+                state.throttled += 1
+                state.remaining = 0
+                state.reset = max(state.reset, self.clock() + 1.0)                  # no reset header: back off a second
+                metrics.counter('twitter_rate_limited')
+                work.put((i, url))                                                  # rebalance to another token
+            elif status != 200:
+                errors.append(Exception(f'Request returned an error: {status} {body}'))
+                return
+            else:
+                results[i] = body
+                if self.cache is not None:
+                    self.cache.put(url, body)
+                with lock:
+                    remaining[0] -= 1
+
+    def run(self, urls):
+        '''
+        Request every url once, across all tokens.
+        Output: list of json responses in the order of urls, whichever token served them
+        '''
+        urls = list(urls)
+        results = [None] * len(urls)
+        work = queue.Queue()
+        for i, url in enumerate(urls):
+            cached = self.cache.get(url) if self.cache is not None else None
+            if cached is not None:
+                results[i] = cached
+            else:
+                work.put((i, url))
+        remaining, lock, errors = [work.qsize()], threading.Lock(), []
+        threads = [threading.Thread(target=self._worker, args=(state, work, results, remaining, lock, errors), daemon=True)
+                   for state in self.states]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def stats(self):
+        '''Requests and 429s per token, tokens abbreviated'''
+        return [{'token': s.token[-4:], 'requests': s.requests, 'throttled': s.throttled} for s in self.states]
+
+def merge_counts(urls, responses):
+    '''
+    Hourly counts rows of counts responses, in url order and then bucket order,
+    so the result doesn't depend on which token served which url or when.
+    Output: dataframe with request_url, start_date, end_date, tweet_count
+    '''
+    rows = []
+    for url, response in zip(urls, responses):
+        for bucket in (response or {}).get('data', []):
+            rows.append((url, bucket['start'], bucket['end'], bucket['tweet_count']))
+    return pd.DataFrame(rows, columns=['request_url','start_date','end_date','tweet_count'])
+
+def tokens_from_config(conf):
+    '''Bearer tokens from hb.cfg: a comma-separated Bearers option, or the single Bearer'''
+    if conf.has_option('Twitter', 'Bearers'):
+        return [t.strip() for t in conf.get('Twitter', 'Bearers').split(',') if t.strip() != '']
+    return [conf.get('Twitter', 'Bearer')]
+
+class FakeCountsAPI():
+    def __init__(self, quota=300, window=900.0, latency=0.0, clock=time.time):
+        '''
+        Local stand-in for the counts endpoint that enforces a request quota per token and window,
+        with x-rate-limit headers and 429s like Twitter. Counts are a fixed function of the url.
+        '''
+        self.quota = quota
+        self.window = window
+        self.latency = latency
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.windows = {}                                                           # token -> (window start, requests)
+
+    def __call__(self, url, token):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        now = self.clock()
+        with self.lock:
+            start, used = self.windows.get(token, (now, 0))
+            if now >= start + self.window:
+                start, used = now, 0
+            headers = {'x-rate-limit-reset': str(start + self.window)}
+            if used >= self.quota:
+                headers['x-rate-limit-remaining'] = '0'
+                return 429, None, headers
+            self.windows[token] = (start, used + 1)
+            headers['x-rate-limit-remaining'] = str(self.quota - used - 1)
+        seed = zlib.crc32(url.encode('utf-8'))
+        data = [{'start': f'2022-02-0{d}T00:00:00.000Z', 'end': f'2022-02-0{d + 1}T00:00:00.000Z',
+                 'tweet_count': (seed >> d) % 7} for d in range(1, 4)]
+        return 200, {'data': data, 'meta': {'total_tweet_count': sum(b['tweet_count'] for b in data)}}, headers
@@ -0,0 +1,81 @@
+import time
+import threading
+from metrics import metrics
+
+class VersionedLoader():
+    def __init__(self, version, load, interval=60, clock=time.time):
+        '''
+        Keep a dataset loaded and replace it only when its source changes.
+        version() is a cheap check of the source (e.g. S3 ETags) and load() the expensive download and parse.
+        The first get() loads synchronously; afterwards get() always returns the current value at once,
+        and at most every interval seconds a background thread compares versions, loads the new data
+        only if the version changed, and swaps (version, value) in with one assignment.
+        Input: version() -> hashable version tag, load() -> value, seconds between version checks
+        '''
+        self.version = version
+        self.load = load
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.current = None                                                         # (version, value)
+        self.checked = 0.0
+        self.refreshing = False
+
+    def get(self):
+        '''Current value; starts a background check when the last one is older than interval'''
+        if self.current is None:
+            with self.lock:
+                if self.current is None:
+                    version = self.version()
+                    self.current = (version, self.load())
+                    self.checked = self.clock()
+            return self.current[1]
+        with self.lock:
+            start = not self.refreshing and self.clock() - self.checked >= self.interval
+            if start:
+                self.refreshing = True
+        if start:
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return self.current[1]
+
+    def refresh(self):
+        '''Check the version and load and swap in the new value if it changed; errors keep the old value'''
+        try:
+            version = self.version()
+            metrics.counter('reload_checks')
+            if version != self.current[0]:
+                self.current = (version, self.load())
+                metrics.counter('reload_swaps')
+        except Exception as e:
+            metrics.counter('reload_errors')
+            print(e)
+        finally:
+            with self.lock:
+                self.checked = self.clock()
+                self.refreshing = False
+
+def s3_version(s3, bucket, prefixes):
+    '''
+    Version of S3 data: ETags of every object under the prefixes, from one listing per 1000 keys
+    instead of reading the data. Changes whenever an object is written, added or removed.
+    Output: tuple of (key, ETag)
+    '''
+    version = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for prefix in prefixes:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            version.extend((obj['Key'], obj['ETag']) for obj in page.get('Contents', []))
+    return tuple(sorted(version))
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+def shared_loader(name, version, load, interval=60):
+    '''
+    Process-wide VersionedLoader by name. Imported modules outlive Streamlit script reruns and
+    st.experimental_singleton.clear(), so every session and rerun shares one loaded copy.
+    '''
+    with _loaders_lock:
+        if name not in _loaders:
+            _loaders[name] = VersionedLoader(version, load, interval)
+        return _loaders[name]
@@ -0,0 +1,112 @@
+import zlib
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+HISTORY_COLUMNS = ['query', 'last_counted', 'last_nonzero', 'zero_streak', 'mentions']
+RUN_KEY = 'data/extracted/twitter/history/run.json'                                  # run number of the last scheduled run
+
+def refresh_run(now=None):
+    '''Run number of the weekly refresh: weeks since 0001-01-01, starting on Mondays'''
+    return ((now or datetime.now()).toordinal() - 1) // 7
+
+def slot(query, every):
+    '''Stable slot in 0..every-1 spreading books evenly over the runs of a cycle'''
+    return zlib.crc32(query.encode('utf-8')) % every
+
+def empty_history():
+    return pd.DataFrame({c: pd.Series(dtype=str if c == 'query' else 'int64') for c in HISTORY_COLUMNS})
+
+def update_history(history_df, counts_df, run):
+    '''
+    Fold one run's book_counts into the per-book history.
+    A packed request's total is shared by all its books: 0 means 0 for every book,
+    and a non-zero total marks every book in it as mentioned, which promotes the whole batch to hot.
+    Input: history dataframe (HISTORY_COLUMNS), book_counts rows (request_url, tweet_count per hourly bucket), run number
+    Output: updated history dataframe
+    '''
+    totals = counts_df.groupby('request_url')['tweet_count'].sum()
+    observed = {}
+    for url, total in totals.items():
+        members = url.split('query=')[1].split('&')[0].split('%20OR%20')
+        for q in members:
+            if len(members) == 1 or q not in observed:                              # a book's own count beats its batch's
+                observed[q] = int(total)
+    history = history_df.set_index('query') if history_df.shape[0] > 0 else empty_history().set_index('query')
+    new = pd.DataFrame({'mentions': pd.Series(observed, dtype='int64')})
+    new.index.name = 'query'
+    history = history.reindex(history.index.union(new.index))
+    history[['last_counted', 'last_nonzero', 'zero_streak', 'mentions']] = \
+        history[['last_counted', 'last_nonzero', 'zero_streak', 'mentions']].fillna(-1).astype('int64')
+    counted = history.index.isin(new.index)
+    mentions = new['mentions'].reindex(history.index).fillna(0).astype('int64')
+    nonzero = counted & (mentions > 0).to_numpy()
+    history.loc[counted, 'last_counted'] = run
+    history.loc[counted, 'mentions'] = mentions[counted]
+    history.loc[nonzero, 'last_nonzero'] = run
+    history.loc[nonzero, 'zero_streak'] = 0
+    zero = counted & ~nonzero
+    history.loc[zero, 'zero_streak'] = history.loc[zero, 'zero_streak'].clip(lower=0) + 1
+    return history.reset_index()[HISTORY_COLUMNS]
+
+class RefreshScheduler():
+    def __init__(self, history_df, run, hot_runs=2, cold_after=6, warm_every=4, cold_every=13):
+        '''
+        Decide which books to count this run from their mention history.
+        hot: mentioned within the last hot_runs runs, or no history yet; counted every run.
+        warm: not mentioned lately, fewer than cold_after zero runs in a row; counted every warm_every runs.
+        cold: cold_after or more zero runs in a row; a rotating 1/cold_every sample is counted each run.
+        Warm and cold books are spread over the runs of their cycle by a stable hash of the query.
+        '''
+        self.history = history_df.set_index('query') if history_df.shape[0] > 0 else empty_history().set_index('query')
+        self.run = run
+        self.hot_runs = hot_runs
+        self.cold_after = cold_after
+        self.warm_every = warm_every
+        self.cold_every = cold_every
+
+    def tiers(self, queries):
+        '''Tier of each query as a pandas series indexed like queries'''
+        queries = pd.Series(list(queries))
+        h = self.history.reindex(queries)
+        last_nonzero = h['last_nonzero'].fillna(-1).to_numpy()
+        zero_streak = h['zero_streak'].fillna(0).to_numpy()
+        known = h['last_counted'].notna().to_numpy()
+        tier = np.where(~known | ((last_nonzero >= 0) & (last_nonzero > self.run - self.hot_runs)), 'hot',
+                        np.where(zero_streak >= self.cold_after, 'cold', 'warm'))
+        return pd.Series(tier, index=queries.index)
+
+    def due(self, queries):
+        '''Boolean array: which queries should be counted this run'''
+        queries = list(queries)
+        tier = self.tiers(queries).to_numpy()
+        warm = np.array([slot(q, self.warm_every) == self.run % self.warm_every for q in queries], dtype=bool)
+        cold = np.array([slot(q, self.cold_every) == self.run % self.cold_every for q in queries], dtype=bool)
+        return (tier == 'hot') | ((tier == 'warm') & warm) | ((tier == 'cold') & cold)
+
+    def report(self, queries, pack=None):
+        '''
+        Summarize the schedule for this run.
+        Input: all book queries; pack: optional function packing book queries into requests, e.g. lib.build_tweet_counts_query
+        Output: dict of statistics
+        '''
+        queries = list(queries)
+        tier = self.tiers(queries)
+        due = self.due(queries)
+        last_counted = self.history.reindex(queries)['last_counted'].fillna(self.run).to_numpy()
+        stats = {
+            'run': self.run,
+            'books': len(queries),
+            'hot': int((tier == 'hot').sum()),
+            'warm': int((tier == 'warm').sum()),
+            'cold': int((tier == 'cold').sum()),
+            'scheduled': int(due.sum()),
+            'coverage': float(due.mean()) if len(queries) > 0 else 1.0,
+            'max_runs_since_counted': int((self.run - last_counted).max()) if len(queries) > 0 else 0,
+        }
+        if pack is not None:
+            before = len(pack(queries))
+            after = len(pack([q for q, d in zip(queries, due) if d]))
+            stats['packed_requests'] = before
+            stats['packed_requests_saved'] = before - after
+        return stats
@@ -0,0 +1,113 @@
+from wordindex import query_words, RarestWordIndex
+
+class SubsumptionIndex():
+    def __init__(self, queries):
+        '''
+        Index of subset relationships between book queries.
+        Twitter and-s the words of a query, so a query whose word set contains another's
+        can never match more tweets than the smaller query:
+        if the subset query has 0 mentions, so do all of its supersets.
+        Subsets are looked up in a RarestWordIndex of the queries' word sets.
+        Input: list or pandas series of query strings
+        '''
+        self.queries = list(queries)
+        self.wordsets = [query_words(q) for q in self.queries]
+        self.position = {q: i for i, q in enumerate(self.queries)}
+        self.index = RarestWordIndex(self.wordsets)
+        self.subsets = [self._find_subsets(i) for i in range(len(self.queries))]
+        self.supersets = [[] for _ in self.queries]
+        for i, subs in enumerate(self.subsets):
+            for j in subs:
+                self.supersets[j].append(i)
+
+    def _find_subsets(self, i):
+        '''Positions of queries whose word set is contained in query i's (equal sets included)'''
+        return sorted(j for j in self.index.contained_in(self.wordsets[i]) if j != i)
+
+    def equivalents(self):
+        '''
+        Positions of queries with the same word set as an earlier query, e.g. "(of%20of%20x%20y)" and "(of%20x%20y)".
+        Their counts are identical, so they never need their own request.
+        '''
+        return [i for i, subs in enumerate(self.subsets) if any(j < i and self.wordsets[j] == self.wordsets[i] for j in subs)]
+
+    def roots(self):
+        '''Positions of queries with no smaller query in the catalog; these always have to be requested'''
+        return [i for i, subs in enumerate(self.subsets) if len(subs) == 0]
+
+    def derive(self, known_counts):
+        '''
+        Derive counts from known ones without asking Twitter.
+        Input: dict of query -> count
+        Output: (dict of query -> 0 for supersets of zero-count queries, dict of query -> upper bound)
+        '''
+        zeros = {}
+        bounds = {}
+        for q, count in known_counts.items():
+            i = self.position.get(q)
+            if i is None:
+                continue
+            for j in self.supersets[i]:
+                sq = self.queries[j]
+                if sq in known_counts:
+                    continue
+                if count == 0:
+                    zeros[sq] = 0
+                else:
+                    bounds[sq] = min(bounds.get(sq, count), count)
+        for q in zeros:
+            bounds.pop(q, None)
+        return zeros, bounds
+
+    def report(self, zero_queries=None, pack=None):
+        '''
+        Summarize how many counts requests the subsumption relationships save.
+        Input: zero_queries: queries that returned 0 (e.g. books in last week's zero batches);
+               pack: optional function packing book queries into requests, e.g. lib.build_tweet_counts_query
+        Output: dict of statistics
+        '''
+        n = len(self.queries)
+        equivalent = set(self.equivalents())
+        with_subset = sum(1 for subs in self.subsets if len(subs) > 0)
+        zeros = {}
+        if zero_queries is not None:
+            zeros, _ = self.derive({q: 0 for q in zero_queries})
+        skipped = equivalent | {self.position[q] for q in zeros}
+        stats = {
+            'queries': n,
+            'roots': n - with_subset,
+            'queries_with_subset': with_subset,
+            'equivalent_word_sets': len(equivalent),
+            'derived_zero': len(zeros),
+            'book_requests_saved': len(skipped),
+        }
+        if pack is not None:
+            before = len(pack(self.queries))
+            after = len(pack([q for i, q in enumerate(self.queries) if i not in skipped]))
+            stats['packed_requests'] = before
+            stats['packed_requests_saved'] = before - after
+        return stats
+
+def zero_queries_from_counts(counts_df):
+    '''
+    Book queries that had no mentions, from book_counts rows (request_url, tweet_count per hourly bucket).
+    A packed request with 0 mentions means 0 for every book in it.
+    '''
+    totals = counts_df.groupby('request_url')['tweet_count'].sum()
+    zero_queries = []
+    for url in totals[totals == 0].index:
+        zero_queries += url.split('query=')[1].split('&')[0].split('%20OR%20')
+    return zero_queries
+
+if __name__ == '__main__':
+    # Report on the current catalog: python subsume.py
+    import awswrangler as wr
+    from lib import build_tweet_counts_query
+    tdf = wr.s3.read_json('s3://warcbooks/data/transformed/isbn/cur_version', dtype=False).drop_duplicates(subset='query')
+    try:
+        counts_df = wr.s3.read_json('s3://warcbooks/data/extracted/twitter/book_counts/most_recent', dtype=False)
+        zero_queries = zero_queries_from_counts(counts_df)
+    except Exception as e:
+        print(e)
+        zero_queries = None
+    print(SubsumptionIndex(tdf['query']).report(zero_queries, pack=build_tweet_counts_query))
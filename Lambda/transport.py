@@ -0,0 +1,103 @@
+import threading
+import functools
+import requests
+from urllib.parse import urlsplit
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import metrics
+
+# One HTTP client for every outbound API call of the app and the Lambda functions.
+# Connections are kept alive per host and reused across calls (and across warm Lambda invocations),
+# so only the first request to a host pays for the TCP and TLS handshakes.
+
+TIMEOUT = (3.05, 30)                                                                # connect, read seconds
+RETRY_STATUSES = (500, 502, 503, 504)                                               # 429s are left to the callers' rate limiting
+
+class Transport():
+    def __init__(self, pool_maxsize=16, per_host=8, retries=3, backoff=0.5, timeout=TIMEOUT):
+        '''
+        Shared requests session with keep-alive connection pools, per-host concurrency limits,
+        default timeouts, gzip and retries with exponential backoff. Failed connections are retried for every method;
+        read timeouts and 5xx only for GET, since a POST (e.g. the ISBNDB bulk lookup) may already have been processed.
+        per_host should not exceed pool_maxsize, so that every request finds a pooled connection.
+        '''
+        self.per_host = per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.semaphores = {}                                                        # host -> BoundedSemaphore
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUSES, allowed_methods=frozenset(['GET']),
+                      respect_retry_after_header=False, raise_on_status=False)       # a 429 must not sleep holding a host slot
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'User-Agent': 'twitterbooks'})
+
+    @contextmanager
+    def slot(self, url):
+        '''Hold one of the per_host concurrent request slots of the url's host'''
+        host = urlsplit(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.setdefault(host, threading.BoundedSemaphore(self.per_host))
+        with semaphore:
+            yield
+
+    def request(self, method, url, headers=None, timeout=None, **kwargs):
+        '''
+        Send a request over the shared session; the body is read before the host slot is released.
+        Output: requests.Response, after retries; error statuses are returned, not raised
+        '''
+        with self.slot(url):
+            with metrics.timer('http_request'):
+                response = self.session.request(method, url, headers=headers, timeout=timeout or self.timeout, **kwargs)
+        metrics.counter('http_requests')
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and len(retries.history) > 0:
+            metrics.counter('http_retries', len(retries.history))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+@functools.lru_cache(maxsize=None)
+def bearer_headers(token):
+    '''Twitter auth headers of a bearer token, built once per token; don't modify the returned dict'''
+    return {'Accept': 'application/json', 'Authorization': f'Bearer {token}'}
+
+@functools.lru_cache(maxsize=None)
+def isbndb_headers(token):
+    '''ISBNDB auth headers of an API key, built once per key; don't modify the returned dict'''
+    return {'Authorization': token, 'accept': 'application/json', 'Content-Type': 'application/json'}
+
+transport = Transport()
+
+def fetch_counts(url, token):
+    '''
+    Request a Twitter counts url with a bearer token over the shared transport.
+    Output: (status code, json response or None, response headers)
+    '''
+    with metrics.timer('twitter_counts_request'):
+        response = transport.get(url, headers=bearer_headers(token))
+    return response.status_code, response.json() if response.status_code == 200 else None, response.headers
+
+def request_counts(url, token):
+    '''
+    Request a Twitter counts url for callers without a credential pool.
+    Output: json response, or None if rate-limited; other errors raise
+    '''
+    status, body, _ = fetch_counts(url, token)
+    metrics.counter('twitter_requests')
+    if status == 429:
+        metrics.counter('twitter_rate_limited')
+        return None
+    if status != 200:
+        raise Exception(f'Request returned an error: {status}')
+    return body
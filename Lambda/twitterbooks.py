@@ -1,8 +1,19 @@
+import os
+import json
 import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import awswrangler as wr
 from datetime import datetime
 from lib import *
+from subsume import SubsumptionIndex, zero_queries_from_counts
+from works import assign_works, WorkFilter
+from isbn import canonical_isbn, load_misses, save_misses
+from schedule import RefreshScheduler, refresh_run, RUN_KEY
+from metrics import metrics, timed
+from columnar import transform_isbn_arrow, from_isbndb_frame, read_isbndb_json, ISBNDB_SCHEMA
+from pipeline import stream_books
     
 def lambda_handler(event, context):
     '''
@@ -11,6 +22,9 @@ def lambda_handler(event, context):
     Extracted book data from ISBNDB is stored on S3://warcbooks/data/extracted/json.
     A master copy of all book data from ISBND is stored on S3://warcbooks/data/extracted/isbn/master.
     '''
+    # metrics are emitted as CloudWatch embedded metric format log lines
+    metrics.configure(function=getattr(context, 'function_name', 'twitterbooks'))
+    
     # version control
     version = 'cur_version'
     
@@ -31,75 +45,135 @@ def lambda_handler(event, context):
     ISBN_TOKEN = conf.get('ISBNDB','Token')                                               
     TWITTER_BEARER = conf.get('Twitter','Bearer')
     
-    # Get latest crawl name from common crawl
-    crawl = get_latest_common_crawl('https://index.commoncrawl.org/collinfo.json')        
-    
     # s3 key abbreviations
     key = 'data/extracted'
     warc_key = f'{key}/warc'                                                              
-    warc_key_json = f'{warc_key}/json/{crawl}/{datestr}'
-    warc_key_parquet = f'{warc_key}/parquet/{crawl}/{datestr}'
+    warc_key_json = f'{warc_key}/json/{datestr}'
+    warc_key_isbns = f'{warc_key}/isbns'                                                  # one deduplicated ISBN table for all crawls
+    crawls_key = f'{warc_key}/processed_crawls.json'
+    misses_key = f'{key}/isbn/misses/bloom.bin'                                           # ISBNs that ISBNDB had no data for
     
      # athena sql parameters
-    catalog = 'ccindex'                                                                  
     db = 'ccindex'
-    table = 'books_' + datestr
-    columns = 'url, warc_filename, warc_record_offset, warc_record_length'
-    filter_column = 'url'
-    regex_filter = "'^https:\/\/www.amazon.com\/[^\/]*\/dp\/(0|1)[0-9]{9}\/.*'"
+    table = 'amazon_isbns'
+    
+    # crawls from common crawl that haven't been processed yet, looking back at most MAX_NEW_CRAWLS crawls
+    max_new_crawls = int(os.environ.get('MAX_NEW_CRAWLS', 3))
+    try:
+        processed_crawls = json.loads(s3.get_object(Bucket=bucket, Key=crawls_key)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        processed_crawls = []
+    
+    # days before ISBNs that ISBNDB had no data for are requested again
+    recheck_days = float(os.environ.get('ISBN_RECHECK_DAYS', 90))
+    
+    # worker processes for transform_isbn; Lambda gets more vCPUs with more memory
+    workers = int(os.environ.get('TRANSFORM_WORKERS', os.cpu_count() or 1))
+    engine = os.environ.get('ENGINE', 'pandas')                                           # 'arrow': columnar.py
+    
+    # PIPELINE=stream publishes each ISBNDB chunk's new books as soon as it arrives (pipeline.py)
+    pipeline = os.environ.get('PIPELINE', 'batch')
+    published = set()
+    stream_fail_count = 0
+    
+    # Dry run: plan the run from the current data without calling the APIs or writing data, then write the plan report
+    if isinstance(event, dict) and event.get('dry_run', False):
+        from planner import plan_run                                                      # planner imports this module
+        tdf = update_transformed(s3, bucket, version, datestr, workers, engine, dry_run=True)
+        tdf = tdf.drop_duplicates(subset='query').drop(columns=['index']).reset_index(drop=True)
+        counts_df, history_df = read_counts_and_history(bucket)
+        plan = plan_run(tdf, counts_df, history_df, refresh_run(), new_isbns=event.get('new_isbns', 0),
+                        athena_tb=event.get('athena_tb', 0.0), tokens=event.get('tokens', 1))
+        s3.put_object(Bucket=bucket, Key=f'data/plans/{datestr}.json', Body=json.dumps(plan, indent=2))
+        metrics.discard()                                                                 # a plan is not a production run
+        return plan
     
     # in case sns_publish doesn't run properly
     sns_fail_count = -1
     
     try:
-        # Parse ISBNs from Amazon URLs in the Common Crawl archives
-        drop_query = query_builder('DROP', db, table)                                   
-        create_query = query_builder('CREATE', db, table, catalog, columns, bucket, warc_key_parquet, 'PARQUET',\
-            where=f"crawl = '{crawl}' AND length(regexp_extract({filter_column}, {regex_filter}))>0")
-        unload_query = query_builder('UNLOAD', db, table, bucket=bucket, key=warc_key_json, formatting='JSON',\
-            select="SPLIT(url,'/')[6] AS ISBN")
-    
-        # Parse Common Crawl's amazon book urls to get ISBNs, use athena to store as json file
-        athena_start_query_execution(athena,drop_query,f's3://{bucket}/{warc_key}/drop_output/{crawl}/{datestr}')               
-        athena_start_query_execution(athena,create_query,f's3://{bucket}/{warc_key}/create_output/{crawl}/{datestr}')
-        athena_start_query_execution(athena,unload_query,f's3://{bucket}/{warc_key}/unload_output/{crawl}/{datestr}')          
+        # Get crawl names from common crawl
+        crawls = get_common_crawls('https://index.commoncrawl.org/collinfo.json')[:max_new_crawls]
+        new_crawls = [crawl for crawl in crawls if crawl not in processed_crawls]
+        if len(new_crawls) == 0:
+            raise Exception('No new crawls to process.')
+        
+        # Parse ISBNs from Amazon URLs in the new crawls, append the unseen ones to the ISBN table and unload them as json files
+        queries = isbn_extraction_queries(db, table, new_crawls, bucket, warc_key_isbns, warc_key_json)
+        for i, query in enumerate(queries):
+            athena_start_query_execution(athena,query,f's3://{bucket}/{warc_key}/query_output/{datestr}/{i}')
         
         # Query ISBNDB API with the ISBNs for book data
         b = s3_resource.Bucket(bucket)                                                        
         df = pd.DataFrame()
-        for obj in b.objects.filter(Prefix='data'):
+        for obj in b.objects.filter(Prefix=warc_key_json):
             if obj.key.startswith(warc_key_json) and obj.key.endswith('.gz'):
                 new_df = pd.read_json(obj.get()['Body'], compression='gzip', lines=True, dtype=False)
                 df = df.append(new_df)
         df = df.drop_duplicates()                                                                      # drop duplicates
-        booksdf = request_ISBNDB(df, 'https://api2.isbndb.com/books', ISBN_TOKEN, chunk_length = 1000) # request book data from ISBNDB
+        
+        # Only request ISBNs with a valid checksum, as ISBN-13, that ISBNDB hasn't recently come back empty for
+        df['isbn'] = df['isbn'].map(canonical_isbn)
+        metrics.counter('isbn_invalid', int(df['isbn'].isna().sum()))
+        df = df.dropna().drop_duplicates()
+        misses = load_misses(s3, bucket, misses_key, recheck_days)
+        known_miss = df['isbn'].map(lambda isbn: isbn in misses).astype(bool)
+        metrics.counter('isbn_known_misses', int(known_miss.sum()))
+        df = df[~known_miss]
+        if df.shape[0] == 0:
+            s3.put_object(Bucket=bucket, Key=crawls_key, Body=json.dumps(processed_crawls + new_crawls))
+            raise Exception('No new ISBNs to request.')
+        if pipeline == 'stream':
+            # Only books whose query, word set and work aren't in the transformed table yet are streamed (select_queries)
+            work_filter = WorkFilter(update_transformed(s3, bucket, version, datestr, workers, engine))
+            topic_arn = get_topic_arn(sns, topic_name)
+            booksdf, published, stream_fail_count = stream_books(isbn_chunks(df, 1000),
+                lambda chunk: request_ISBNDB_chunk(chunk, 'https://api2.isbndb.com/books', ISBN_TOKEN),
+                lambda chunkdf: transform_isbn(chunkdf, 1, engine),
+                lambda batch: publish_sns_batch(sns, topic_arn, batch),
+                select=work_filter.select,
+                make_batches=lambda urls, i: get_batches(urls, f'{datestr}:stream{i}:'))
+        else:
+            booksdf = request_ISBNDB(df, 'https://api2.isbndb.com/books', ISBN_TOKEN, chunk_length = 1000) # request book data from ISBNDB
         booksdf = booksdf.reset_index().drop(columns='index')                                          # index must be unique
-        wr.s3.to_json(df=booksdf, path=f's3://{bucket}/{key}/isbn/{version}/{datestr}.json') # write to S3 as json files      
-    
-        # Transform and store
-        trans_df = transform_isbn(booksdf)
-        wr.s3.to_json(df=trans_df, path=f's3://{bucket}/data/transformed/isbn/{version}/{datestr}.json')
-    
-    except:
-        pass  # If Common Crawl API throws a "Please reduce your rate" exception, work with existing master book data
-    
-    booksdf = wr.s3.read_json(f's3://warcbooks/data/extracted/isbn/cur_version')
-    trans_df = transform_isbn(booksdf)
-    wr.s3.to_json(df=trans_df, path=f's3://{bucket}/data/transformed/isbn/{version}/{datestr}.json')
+        found = set(booksdf['isbn13'].map(canonical_isbn)) if 'isbn13' in booksdf.columns else set()
+        for isbn in df['isbn']:
+            if isbn not in found:
+                misses.add(isbn)
+        save_misses(s3, bucket, misses_key, misses)
+        wr.s3.to_json(df=booksdf, path=f's3://{bucket}/{key}/isbn/{version}/{datestr}.jsonl', orient='records', lines=True) # json lines: Arrow reads them directly
+        s3.put_object(Bucket=bucket, Key=crawls_key, Body=json.dumps(processed_crawls + new_crawls))   # rerunning a crawl is idempotent until here
     
+    except Exception as e:
+        print(e)  # If Common Crawl API throws a "Please reduce your rate" exception or there are no new crawls, work with existing master book data
     
-    # Regardless of whether queries to ISBN ran successfully, read all transformed data
-    tdf = wr.s3.read_json(f's3://{bucket}/data/transformed/isbn/{version}', dtype=False)
+    # Regardless of whether queries to ISBN ran successfully, transform the master files not transformed yet
+    # and read the whole transformed table
+    tdf = update_transformed(s3, bucket, version, datestr, workers, engine)
     
     # Drop duplicates if two twitter queries are the same, keep first
-    tdf = tdf.drop_duplicates(subset='query').drop(columns=['index']).reset_index().drop(columns=['index'])
+    tdf = tdf.drop_duplicates(subset='query').drop(columns=['index']).reset_index(drop=True)
+    
+    # Editions are counted once per work, repeated word sets once, and books on a tiered cadence (select_queries)
+    # The run number is kept with the run's outputs: main_batch_topbooks runs a day later, maybe in the next week
+    counts_df, history_df = read_counts_and_history(bucket)
+    run = refresh_run()
+    tdf, works_df, subsume_report, schedule_report = select_queries(tdf, counts_df, history_df, run)
+    s3.put_object(Bucket=bucket, Key=RUN_KEY, Body=json.dumps({'run': run, 'datestr': datestr}))
+    wr.s3.to_json(df=works_df, path=f's3://{bucket}/data/transformed/works/{version}/works.json')
+    print(subsume_report)
+    print(schedule_report)
+    metrics.counter('books_scheduled', schedule_report['scheduled'])
+    metrics.counter('books_deferred', schedule_report['books'] - schedule_report['scheduled'])
+    tdf = tdf[~tdf['query'].isin(published)].reset_index(drop=True)                       # already published by the stream
     
     # Pack 10ish books into each query to reduce the number of queries to Twitter API
     queries = build_tweet_counts_query(tdf['query'])
     
     # Publish list of chunked queries via SNS to the appropriate topic
-    sns_batches = get_sns_batches(queries)
-    sns_fail_count = sns_publish(sns, sns_batches, topic_name)
+    # MESSAGE_FORMAT=coalesced sends dozens of queries per message, for consumers using lib.handle_query_messages
+    sns_batches = get_batches(queries, f'{datestr}:')
+    sns_fail_count = sns_publish(sns, sns_batches, topic_name) + stream_fail_count
     
     # Empty last run's most_recent folders to prep for the next lambda function
     try:
@@ -108,12 +182,173 @@ def lambda_handler(event, context):
     except Exception as e:
         print(e)
         
+    metrics.counter('isbn_records', tdf.shape[0])
+    metrics.flush()
     return f'{tdf.shape[0]} isbn records were added. SNS failed to publish {sns_fail_count} messages.'
 
-def transform_isbn(tdf):
+def get_batches(queries, run_id):
+    '''
+    SNS batches of counts urls in the MESSAGE_FORMAT of the deployment: one url per message (default),
+    or dozens per message (coalesced), for consumers using lib.handle_query_messages
+    '''
+    if os.environ.get('MESSAGE_FORMAT', 'url') == 'coalesced':
+        sns_batches = get_coalesced_sns_batches(queries, run_id)
+        metrics.counter('sns_coalesced_messages', sum(len(batch) for batch in sns_batches))
+        return sns_batches
+    return get_sns_batches(queries)
+
+def read_counts_and_history(bucket):
+    '''
+    Last run's book_counts and the per-book mention history, if they exist
+    Output: counts dataframe or None, history dataframe (empty: every book is hot)
+    '''
+    try:
+        counts_df = wr.s3.read_json(f's3://{bucket}/data/extracted/twitter/book_counts/most_recent', dtype=False)
+    except Exception as e:
+        print(e)
+        counts_df = None
+    try:
+        history_df = wr.s3.read_json(f's3://{bucket}/data/extracted/twitter/history/history.json', dtype=False)
+    except Exception as e:
+        print(e)
+        history_df = pd.DataFrame(columns=['query'])
+    return counts_df, history_df
+
+def select_queries(tdf, counts_df, history_df, run):
+    '''
+    Choose the book queries to count this run from the deduplicated transformed table; no I/O, so the planner runs it too.
+    Editions, bindings and reprints of the same work are counted once, through the query of the work's earliest row
+    in the transformed table (not necessarily the first edition), so a work keeps the same history key across runs.
+    Books whose query words repeat an earlier query's get identical counts, so they aren't requested again.
+    Recently mentioned books are counted every run, books that keep coming back at zero less often.
+    Input: transformed table, last run's book_counts (or None), mention history, refresh run number
+    Output: book queries to count, works (isbn, work_id, work_year), subsumption report, schedule report
+    '''
+    tdf = assign_works(tdf)
+    works_df = tdf[['isbn','work_id','work_year']]
+    tdf = tdf.drop_duplicates(subset='work_id').reset_index(drop=True)
+    
+    # Report how many more requests last week's zero batches could have saved through subset queries
+    index = SubsumptionIndex(tdf['query'])
+    zero_queries = zero_queries_from_counts(counts_df) if counts_df is not None else None
+    subsume_report = index.report(zero_queries, pack=build_tweet_counts_query)
+    tdf = tdf.drop(index=tdf.index[index.equivalents()]).reset_index(drop=True)
+    
+    scheduler = RefreshScheduler(history_df, run)
+    schedule_report = scheduler.report(tdf['query'], pack=build_tweet_counts_query)
+    tdf = tdf[scheduler.due(tdf['query'])].reset_index(drop=True)
+    return tdf, works_df, subsume_report, schedule_report
+
+@timed()
+def update_transformed(s3, bucket, version, datestr, workers=1, engine='pandas', dry_run=False):
+    '''
+    Transform only the ISBNDB master files that haven't been transformed yet and append their new queries
+    to the transformed table, as one file per run. Rows already in the table come first, so deduplication
+    on query keeps the same book as a full transform of the master would.
+    The keys of transformed master files are kept as a watermark next to the table. Without one, the whole master
+    is transformed once and replaces the earlier full copies in the table directory.
+    dry_run: transform the new files in memory only, writing nothing
+    Output: the whole transformed table
+    '''
+    source = f's3://{bucket}/data/extracted/isbn/{version}/'
+    table = f's3://{bucket}/data/transformed/isbn/{version}/'
+    watermark_key = f'data/transformed/isbn_state/{version}/processed_keys.json'
+    try:
+        processed = json.loads(s3.get_object(Bucket=bucket, Key=watermark_key)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        processed = None                                                            # first run: full transform
+    table_files = wr.s3.list_objects(table)
+    if processed is not None and len(table_files) > 0:
+        tdf = wr.s3.read_json(table, dtype=False)
+    else:
+        tdf = pd.DataFrame(columns=['index','query'])
+    
+    done = set(processed or [])
+    new_keys = [k for k in wr.s3.list_objects(source) if k not in done]
+    metrics.counter('transform_new_files', len(new_keys))
+    if len(new_keys) == 0:
+        return tdf
+    if engine == 'arrow':
+        # Arrow from the master files to the write: json lines are parsed by Arrow, only the new rows become pandas
+        delta = transform_isbn_arrow(read_master_arrow(s3, bucket, new_keys))
+        existing = pa.array(tdf['query'].astype(str).tolist(), pa.string())
+        delta = delta.filter(pc.invert(pc.is_in(delta['query'], value_set=existing))).to_pandas()
+    else:
+        delta = transform_isbn(read_master(new_keys), workers, engine)
+        delta = delta[~delta['query'].isin(tdf['query'])]                           # global dedup: existing rows win
+    metrics.counter('transform_new_rows', delta.shape[0])
+    if dry_run:
+        return pd.concat([tdf, delta], ignore_index=True)
+    delta_path = f'{table}{datestr}.json'
+    wr.s3.to_json(df=delta, path=delta_path)
+    if processed is None:
+        stale = [f for f in table_files if f != delta_path]
+        if len(stale) > 0:
+            wr.s3.delete_objects(stale)                                             # earlier full copies
+    s3.put_object(Bucket=bucket, Key=watermark_key, Body=json.dumps((processed or []) + new_keys))
+    return pd.concat([tdf, delta], ignore_index=True)
+
+def read_master(keys):
+    '''ISBNDB master files as one pandas dataframe: json lines (.jsonl), or column-oriented json from earlier runs'''
+    lines = [k for k in keys if k.endswith('.jsonl')]
+    legacy = [k for k in keys if not k.endswith('.jsonl')]
+    frames = ([wr.s3.read_json(path=lines, orient='records', lines=True)] if len(lines) > 0 else []) + \
+             ([wr.s3.read_json(path=legacy)] if len(legacy) > 0 else [])
+    return pd.concat(frames, ignore_index=True)
+
+def read_master_arrow(s3, bucket, keys):
+    '''
+    ISBNDB master files as one Arrow table (ISBNDB_SCHEMA), in key order.
+    Json lines are parsed by Arrow without pandas; column-oriented files from earlier runs,
+    and json lines Arrow can't fit into the schema, go through pandas once.
+    '''
+    tables = []
+    for k in keys:
+        table = None
+        if k.endswith('.jsonl'):
+            try:
+                table = read_isbndb_json(s3.get_object(Bucket=bucket, Key=k.split(f's3://{bucket}/', 1)[1])['Body'].read())
+            except pa.ArrowInvalid as e:
+                print(f'{k}: {e}')
+        if table is None:
+            table = from_isbndb_frame(read_master([k])).cast(ISBNDB_SCHEMA)
+        tables.append(table)
+    return pa.concat_tables(tables)
+
+@timed()
+def transform_isbn(tdf, workers=1, engine='pandas'):
     '''
     Transforms ISBNDB data to be used in twitter queries.
-    Input: pandas dataframe
+    Per-row work runs in chunks across worker processes if workers > 1;
+    the global steps (deduplication, index) run once on the merged chunks, so the output is identical.
+    engine='arrow' runs columnar.transform_isbn_arrow in one process instead.
+    Input: pandas dataframe, number of worker processes, engine
+    Output: pandas dataframe
+    '''
+    if engine == 'arrow':
+        return transform_isbn_arrow(from_isbndb_frame(tdf)).to_pandas()
+    
+    # Per row: build and clean up queries
+    tdf = pd.concat(map_chunks(transform_isbn_rows, split_frame(tdf, workers)))
+    
+    # Global: duplicate rows across chunks
+    tdf = tdf.drop_duplicates()
+    tdf = tdf.reset_index()
+    
+    # Per row: filter queries and sort their words
+    tdf = pd.concat(map_chunks(filter_isbn_queries, split_frame(tdf, workers)))
+    
+    # Global: drop duplicates on sorted query, keep first, then queries that are only author names
+    tdf = tdf.drop_duplicates(subset=['query'])
+    tdf = tdf[~tdf['author_only'].astype(bool)]
+    tdf = tdf.drop(columns=['author_only'])
+    
+    return tdf
+
+def transform_isbn_rows(tdf):
+    '''
+    Per-row part of transform_isbn: choose columns, join authors, build query strings.
+    Input: pandas dataframe of ISBNDB data
     Output: pandas dataframe
     '''
     # Choose columns of interest
@@ -121,6 +356,8 @@ def transform_isbn(tdf):
     
     # Handle authors
     tdf = tdf[tdf['authors'].apply(lambda x: isinstance(x, list))]       # discard rows if data type of 'authors' != list
+    if tdf.shape[0] == 0:                                                # chunk without authors; .str needs strings
+        return tdf.assign(title_short=pd.Series(dtype=object), query=pd.Series(dtype=object))
     tdf['authors'] = [' '.join(l) for l in tdf.authors.tolist()]         # convert 'authors' to string, remove comma
     tdf['authors'] = tdf['authors'].str.strip()
     tdf = tdf[tdf['authors']!='']                                        # discard rows if 'authors' is blank
@@ -137,9 +374,15 @@ def transform_isbn(tdf):
     rm_words = ['a','an','the','dr','mr','mrs','prof','msgr','rev','rt','sr','jr','phd','lcsw','esq']
     rm_chars = ['\(.*?\)','\<.*?\>']
     tdf = remove_regex(tdf,'query',rm_words,rm_chars,code_space=True, add_paren=True)
-    
+    return tdf
+
+def filter_isbn_queries(tdf):
+    '''
+    Per-row part of transform_isbn: discard unusable queries, sort query words, flag author-only queries.
+    Input: pandas dataframe from transform_isbn_rows, after reset_index
+    Output: pandas dataframe with an 'author_only' column
+    '''
     # Clean up
-    tdf = tdf.reset_index()                                     
     tdf['authors'] = tdf['authors'].str.strip() 
     tdf = tdf[tdf['authors']!='']                                    
     tdf = tdf[pd.notna(tdf['pages'])]                                # has page count
@@ -183,10 +426,8 @@ def transform_isbn(tdf):
     tdf['querysplit']=querysplit
     tdf['queryset']=queryset
     tdf['querysplit'] = [sorted(q) for q in tdf['querysplit']]      # sort words in query
-    tdf['query']=tdf['querysplit'].str.join('%20')
-    tdf['query']=['('+q+')' for q in tdf['query']] 
-    tdf = tdf.drop_duplicates(subset=['query'])                     # drop duplicates on sorted query
-    tdf = tdf[tdf['queryset']!=tdf['authorset']]                    # drop queries that are only author names
+    tdf['query']=['('+'%20'.join(q)+')' for q in tdf['querysplit']] # .str would fail on chunks left empty by the filters
+    tdf['author_only'] = tdf['queryset']==tdf['authorset']          # queries that are only author names
     tdf = tdf.drop(columns=['authorset','queryset','authorsplit','querysplit'])
     
     return tdf
\ No newline at end of file
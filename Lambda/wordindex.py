@@ -0,0 +1,30 @@
+from collections import Counter, defaultdict
+
+def query_words(query):
+    '''Word set of a transform_isbn query, e.g. "(virginia%20waves%20woolf)"'''
+    return frozenset(w for w in query.strip('()').split('%20') if w != '')
+
+class RarestWordIndex():
+    def __init__(self, wordsets):
+        '''
+        Inverted index of word sets, each filed under its rarest word across all the sets (ties: the smallest word).
+        Any set contained in a set of words S has its rarest word in S, so the sets contained in S
+        are found among the few sets filed under S's words, without scanning the others.
+        Input: list of word sets
+        '''
+        self.wordsets = wordsets
+        freq = Counter(w for ws in wordsets for w in ws)
+        by_rarest = defaultdict(list)
+        for i, ws in enumerate(wordsets):
+            if len(ws) > 0:
+                by_rarest[min(ws, key=lambda w: (freq[w], w))].append(i)
+        self.by_rarest = dict(by_rarest)
+
+    def contained_in(self, words):
+        '''Positions of the indexed word sets contained in words (a set), in index order per word'''
+        found = []
+        for w in words:
+            for i in self.by_rarest.get(w, ()):
+                if self.wordsets[i] <= words:
+                    found.append(i)
+        return found
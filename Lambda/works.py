@@ -0,0 +1,129 @@
+import re
+import math
+import pandas as pd
+from collections import Counter
+from wordindex import query_words
+
+AUTHOR_STOP = {'dr','mr','mrs','ms','prof','msgr','rev','rt','sr','jr','phd','lcsw','esq','md','editor','ed'}
+TITLE_STOP = {'a','an','the','and','of','&'}
+
+def author_block(authors):
+    '''
+    Blocking key for an author string: sorted lowercase name tokens without initials and honorifics,
+    so "Woolf, Virginia" and "Virginia Woolf" fall in the same block.
+    '''
+    tokens = re.sub(r'\W', ' ', str(authors).lower()).split()
+    return ' '.join(sorted({t for t in tokens if len(t) > 1 and t not in AUTHOR_STOP}))
+
+def title_tokens(title):
+    '''Word set of a title without subtitles, parentheses and articles'''
+    title = re.sub(r'\(.*?\)|\[.*?\]', ' ', str(title).split(':')[0].lower())
+    return frozenset(t for t in re.sub(r'\W', ' ', title).split() if t not in TITLE_STOP)
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if len(a | b) > 0 else 0.0
+
+def similar_pairs(sets, threshold):
+    '''
+    Pairs (x, y), x < y, of word sets with Jaccard >= threshold, without comparing every pair (prefix filtering).
+    With the words of every set in one order, rarest first, two sets that reach the threshold
+    share a word among the first len - ceil(threshold * len) + 1 words of each, so only sets
+    sharing such a prefix word are compared. Blocks of thousands of titles, e.g. "Various" or "Anonymous",
+    stay near-linear because their titles rarely share rare words.
+    '''
+    freq = Counter(w for ws in sets for w in ws)
+    index = {}
+    pairs = []
+    for y, ws in enumerate(sets):
+        words = sorted(ws, key=lambda w: (freq[w], w))
+        prefix = len(words) - math.ceil(threshold * len(words) - 1e-9) + 1
+        candidates = set()
+        for w in words[:prefix]:
+            candidates.update(index.get(w, ()))
+            index.setdefault(w, []).append(y)
+        pairs += [(x, y) for x in sorted(candidates) if jaccard(sets[x], ws) >= threshold]
+    return pairs
+
+def assign_works(tdf, threshold=0.8):
+    '''
+    Cluster editions of the same work: same author block and similar titles (token Jaccard >= threshold).
+    Input: pandas dataframe with isbn, title, authors, date_published (e.g. transform_isbn output)
+    Output: dataframe with work_id (smallest isbn of the work) and work_year (earliest year of the work)
+    '''
+    tdf = tdf.copy()
+    blocks = [author_block(a) for a in tdf['authors']]
+    titles = [title_tokens(t) for t in tdf['title']]
+    parent = list(range(tdf.shape[0]))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # within each author block, join similar distinct titles (similar_pairs); editions with equal titles are joined directly
+    by_block = {}
+    for i, (block, title) in enumerate(zip(blocks, titles)):
+        if block != '' and len(title) > 0:
+            by_block.setdefault(block, {}).setdefault(title, []).append(i)
+    for block_titles in by_block.values():
+        distinct = list(block_titles.items())
+        for title, rows in distinct:
+            for i in rows[1:]:
+                parent[find(i)] = find(rows[0])
+        for x, y in similar_pairs([title for title, _ in distinct], threshold):
+            parent[find(distinct[y][1][0])] = find(distinct[x][1][0])
+
+    roots = [find(i) for i in range(tdf.shape[0])]
+    isbns = tdf['isbn'].astype(str).tolist()
+    years = pd.to_numeric(tdf['date_published'].astype(str).str[:4], errors='coerce')
+    tdf['work_id'] = pd.Series(isbns, index=tdf.index).groupby(roots).transform('min').to_numpy()
+    tdf['work_year'] = years.groupby(roots).transform('min').to_numpy()
+    return tdf
+
+class WorkFilter():
+    def __init__(self, tdf, threshold=0.8):
+        '''
+        The dedup of select_queries, for books that arrive one chunk at a time after the transformed table tdf:
+        a book is dropped if an earlier book has its query, its query's word set (SubsumptionIndex.equivalents)
+        or a title of the same work (same author block and title Jaccard >= threshold, as in assign_works).
+        Books kept by select() count as earlier books for the next chunks.
+        Input: pandas dataframe with query, title and authors, e.g. the transformed table
+        '''
+        self.threshold = threshold
+        self.wordsets = set()
+        self.titles = {}                                                            # author block -> list of title word sets
+        self.by_word = {}                                                           # (author block, word) -> positions in titles
+        self.add(tdf)
+
+    def add(self, tdf):
+        '''Record the books of a dataframe as earlier books'''
+        for query, authors, title in zip(tdf['query'], tdf['authors'], tdf['title']):
+            self.add_book(query, authors, title)
+
+    def add_book(self, query, authors, title):
+        self.wordsets.add(query_words(query))
+        block, tokens = author_block(authors), title_tokens(title)
+        if block != '' and len(tokens) > 0:
+            titles = self.titles.setdefault(block, [])
+            for w in tokens:
+                self.by_word.setdefault((block, w), []).append(len(titles))
+            titles.append(tokens)
+
+    def same_work(self, authors, title):
+        '''Whether an earlier book is an edition of the same work'''
+        block, tokens = author_block(authors), title_tokens(title)
+        if block == '' or len(tokens) == 0:
+            return False
+        titles = self.titles.get(block, [])
+        candidates = {i for w in tokens for i in self.by_word.get((block, w), ())}   # Jaccard > 0 needs a shared word
+        return any(jaccard(titles[i], tokens) >= self.threshold for i in candidates)
+
+    def select(self, tdf):
+        '''Rows of tdf that are neither the same word set nor the same work as an earlier book, then recorded as earlier books'''
+        keep = []
+        for query, authors, title in zip(tdf['query'], tdf['authors'], tdf['title']):
+            new = query_words(query) not in self.wordsets and not self.same_work(authors, title)
+            if new:
+                self.add_book(query, authors, title)
+            keep.append(new)
+        return tdf[keep].reset_index(drop=True)
@@ -5,24 +5,47 @@ import streamlit as st
 import datetime
 import time
 import random
-import requests
 import streamlit.components.v1 as components
 import altair as alt
 import json
 import boto3
+import os
+import sys
+import bisect
+
+# modules shared with the lambda functions
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Lambda'))
+from cache import CountsCache
+from catalog import open_catalog
+from hourly import open_hourly
+from metrics import metrics, timed
+from transport import transport, bearer_headers, request_counts
+from reload import shared_loader, s3_version
+
+# app metrics go to a local file in CloudWatch embedded metric format
+metrics.configure(function='app', path='/tmp/twitterbooks_metrics.jsonl', stdout=False)
 
 # wide mode
 st.set_page_config(layout="wide")
 
-# cache results
-@st.experimental_memo(ttl=3600)
-def caching():
+# session keys that are not rows of the session dataframe
+SESSION_KEYS = ['title','update','author','update_ind','auto_rerun','chart_aggregates']
+
+# S3 data behind caching(), checked for changes every minute
+DATA_BUCKET = 'warcbooks'
+DATA_PREFIXES = ['data/main/batch/topbooks/most_recent/', 'data/main/batch/isbn/cur_version']
+CATALOG_KEY = 'data/main/batch/catalog/cur_version/catalog.bin'
+HOURLY_KEY = 'data/main/batch/hourly/most_recent/topbooks'                          # .bin and .json
+
+@timed('app_refresh')
+def load_data():
    '''
    Read twitter API results and number of books queried from S3
    '''
    # twitter api results
    key = 's3://warcbooks/data/main/batch/topbooks/most_recent/topbooks.json'
    df = wr.s3.read_json(path=key, dtype=False)
+   df['year'] = df['year'].astype(int)
 
    # number of books queried
    booksdf = wr.s3.read_json(path='s3://warcbooks/data/main/batch/isbn/cur_version', dtype=False)
@@ -34,6 +57,51 @@ def caching():
 
    return df, num_books, q_start, q_end
 
+def data_version():
+   '''ETags of the S3 data, from one listing per prefix'''
+   return s3_version(boto3.client('s3'), DATA_BUCKET, DATA_PREFIXES)
+
+def caching():
+   '''
+   Twitter API results and number of books queried, shared by all sessions.
+   Only the first call waits for S3; afterwards a background check of the objects' ETags
+   re-reads the data only when the batch job has written a new version, and swaps it in for the next rerun.
+   Each call gets its own copy of the dataframe, as with experimental_memo, since sessions run in parallel threads.
+   '''
+   df, num_books, q_start, q_end = shared_loader('app_data', data_version, load_data, interval=60).get()
+   return df.copy(), num_books, q_start, q_end
+
+def catalog_version():
+   '''ETag of the catalog file'''
+   return s3_version(boto3.client('s3'), DATA_BUCKET, [CATALOG_KEY])
+
+def load_catalog():
+   '''Download the catalog and map it; open maps of the old file stay valid'''
+   local_file = '/tmp/twitterbooks_catalog.bin'
+   wr.s3.download(path=f's3://{DATA_BUCKET}/{CATALOG_KEY}', local_file=local_file + '.tmp')
+   os.replace(local_file + '.tmp', local_file)
+   return open_catalog(local_file)
+
+def get_catalog():
+   '''
+   Memory-mapped catalog of every tracked book.
+   The file is downloaded once per batch run and shared by all sessions through the page cache.
+   '''
+   return shared_loader('catalog', catalog_version, load_catalog, interval=60).get()
+
+def search_catalog(search):
+   '''
+   Find tracked books by title or author prefix.
+   Input: search string
+   Output: dataframe of matching books
+   '''
+   catalog = get_catalog()
+   results = catalog.prefix(search, by='title') + catalog.prefix(search, by='author')
+   sdf = pd.DataFrame(results, columns=['isbn','title','authors','year','mentions']).drop_duplicates(subset=['isbn'])
+   sdf['mentions'] = sdf['mentions'].where(sdf['mentions']>=0)  # -1: not counted individually this week
+   sdf['year'] = sdf['year'].where(sdf['year']>=0)
+   return sdf.reset_index(drop=True)
+
 def tweets(qlist):
    '''
    Get recent tweets of the books on the list.
@@ -45,10 +113,9 @@ def tweets(qlist):
       for q in qlist:
          # specify response fields
          url=f'https://api.twitter.com/2/tweets/search/recent?query={q}&max_results=10&expansions=author_id&user.fields=username&tweet.fields=created_at'
-         headers = {'Accept': 'application/json','Authorization': f"Bearer {st.secrets.t_bearer_token}"} # send request to twitter
-         
-         # request and parse
-         r = requests.get(url=url, headers=headers).json()
+
+         # request and parse, over the shared keep-alive connection to twitter
+         r = transport.get(url, headers=bearer_headers(st.secrets.t_bearer_token)).json()
          if 'data' in r:
             for user in r['includes']['users']:
                if user['id'] == r['data'][0]['author_id']:
@@ -125,8 +192,7 @@ def get_pretty_tweets(df):
    for i,tid in enumerate(tids):
       tusername = tusernames[i]
       url = f'https://publish.twitter.com/oembed?url=https%3A%2F%2Ftwitter.com%2F{tusername}%2Fstatus%2F{tid}'
-      headers = {'Accept': 'application/json','Authorization': f"Bearer {st.secrets.t_bearer_token}"} # send request to twitter
-      resp = requests.get(url=url, headers=headers).json()
+      resp = transport.get(url, headers=bearer_headers(st.secrets.t_bearer_token)).json()
       hstr += resp['html']
    hstr = hstr.replace('blockquote class','blockquote data-theme="dark" class')
    return hstr
@@ -151,7 +217,7 @@ def build_sessiondf(df,rebuild=datetime.date(1900,1,1)):
    # build session dataframe
    sessiondf = pd.DataFrame(columns=['shortened_title','author(s)','year','mentions','query'])
    for key in st.session_state.keys():
-      if key != 'title' and key != 'update' and key != 'author' and key != 'update_ind' and key != 'auto_rerun':
+      if key not in SESSION_KEYS:
          print(st.session_state[key])
          temp_df = pd.DataFrame({'shortened_title':st.session_state[key][0],\
                   'author(s)':st.session_state[key][1],\
@@ -176,6 +242,75 @@ def color_new_mention(s):
    else:
       return ['background-color: #0f1116']*len(s)
 
+class ChartAggregates():
+   def __init__(self, sessiondf):
+      '''
+      Mention totals behind the stats charts, by year, by 25-year range and by author.
+      update_count changes one book per tick, so totals are updated by deltas
+      and each chart is only rebuilt when its totals changed.
+      '''
+      max_year = datetime.date.today().year
+      self.bins = list(range(1900,max_year,25))
+      self.bins.insert(0,-10000)
+      self.bins.append(max_year)
+      self.labels = [str(bin)+' - '+str(self.bins[i+1]) for i, bin in enumerate(self.bins) if i < len(self.bins)-1]
+      self.by_year = {}
+      self.by_range = {label: 0 for label in self.labels}
+      self.by_author = {}
+      self.versions = {'year': 0, 'range': 0, 'author': 0}
+      self.charts = {}                                         # chart name -> (version, chart)
+      for row in sessiondf[['year','author(s)','mentions']].itertuples(index=False):
+         self.apply(int(row[0]), row[1], int(row[2]))
+
+   def year_range(self, year):
+      '''Label of the 25-year range of a year, as pd.cut would assign it (right-inclusive)'''
+      i = bisect.bisect_left(self.bins, year)
+      return self.labels[i-1] if 0 < i < len(self.bins) else None
+
+   def apply(self, year, author, delta):
+      '''Add a change in one book's mentions to the totals'''
+      if delta == 0:
+         return
+      self.by_year[year] = self.by_year.get(year, 0) + delta
+      self.versions['year'] += 1
+      label = self.year_range(year)
+      if label is not None:
+         self.by_range[label] += delta
+         self.versions['range'] += 1
+      self.by_author[author] = self.by_author.get(author, 0) + delta
+      self.versions['author'] += 1
+
+   def memo(self, name, version, build):
+      '''Chart spec for name, rebuilt only if its version changed'''
+      if name not in self.charts or self.charts[name][0] != version:
+         self.charts[name] = (version, build())
+      return self.charts[name][1]
+
+   def year_chart(self):
+      def build():
+         df_indexed = pd.DataFrame(sorted(self.by_year.items()), columns=['year_of_publication','mentions'])
+         return alt.Chart(df_indexed).mark_bar().encode(x=alt.X('year_of_publication', sort=None), y='mentions')
+      return self.memo('year', self.versions['year'], build)
+
+   def year_range_chart(self):
+      def build():
+         year_range_df = pd.DataFrame(list(self.by_range.items()), columns=['year_of_publication','mentions'])
+         return alt.Chart(year_range_df,width=400, height=300).mark_bar().encode(x=alt.X('year_of_publication', sort=None), y='mentions')
+      return self.memo('range', self.versions['range'], build)
+
+   def author_charts(self):
+      '''Author charts of about 15 authors each; a chart is rebuilt only if its slice of authors changed'''
+      authordf = pd.DataFrame(list(self.by_author.items()), columns=['author(s)','mentions'])
+      authordf = authordf.sort_values(by=['mentions'],ascending=False,kind='stable').reset_index(drop=True)
+      split_dfs = np.array_split(authordf, int(authordf.shape[0]/(min(authordf.shape[0],15))))
+      charts = []
+      for i, split_df in enumerate(split_dfs):
+         rows = tuple(split_df.itertuples(index=False))
+         build = lambda split_df=split_df: alt.Chart(split_df,width=400).mark_bar().encode(x=alt.X('author(s)', sort=None), y='mentions')
+         charts.append(self.memo(f'author_{i}', rows, build))
+      return charts
+
+@timed('app_render')
 def main():
 
    # cache data from S3
@@ -218,7 +353,6 @@ def main():
    col1.code('{:,} books tracked, {} — {}'.format(num_books,q_start.strftime('%B %-d, %Y %H:%M:%S'), q_end.strftime('%B %-d, %Y %H:%M:%S')))
 
    # build session table
-   df['year'] = df['year'].astype(int)
    if 'update_ind' not in st.session_state:
       st.session_state['update_ind'] = 0
    sessiondf = build_sessiondf(df,rebuild)
@@ -234,6 +368,14 @@ def main():
 
    # display display table
    col1.dataframe(dispdf.style.apply(color_new_mention, axis=1), height=3000)
+
+   # search every tracked book, not just the top 100
+   search = col1.text_input('Search tracked books by title or author')
+   if search != '':
+      try:
+         col1.dataframe(search_catalog(search))
+      except Exception as e:
+         print(e)
    
    # tweets
    with col2:
@@ -251,42 +393,24 @@ def main():
    col2.write('By Year')
    col2.text('')
 
+   # chart aggregates are kept across update reruns and receive deltas from update_count
+   if 'chart_aggregates' not in st.session_state:
+      st.session_state['chart_aggregates'] = ChartAggregates(sessiondf)
+   aggregates = st.session_state['chart_aggregates']
+
    # chart 1: by publication year
-   df_indexed = df.rename(columns={"year":"year_of_publication"})
-   df_indexed = df_indexed[['year_of_publication','mentions']].groupby(['year_of_publication']).sum().reset_index()
-   col2.write(alt.Chart(df_indexed).mark_bar().encode(
-      x=alt.X('year_of_publication', sort=None),
-      y='mentions',
-   ))
+   col2.write(aggregates.year_chart())
 
    # chart 2: group mention counts by year and by quantiles
-   yeardf = df[['year','mentions']].groupby(['year']).sum()
-   yeardf = yeardf.reset_index()
-   yeardf['year'] = yeardf['year'].astype(int)
-   max_year = datetime.date.today().year
-   bins = list(range(1900,max_year,25))
-   bins.insert(0,-10000)
-   bins.append(max_year)
-   labels = [str(bin)+' - '+str(bins[i+1]) for i, bin in enumerate(bins) if i < len(bins)-1]
-   yeardf['year_of_publication'] = pd.cut(yeardf['year'], bins=bins, labels=labels)
-   year_range_df = yeardf.groupby(['year_of_publication']).sum().reset_index().drop(columns=['year'])
-   col2.write(alt.Chart(year_range_df,width=400, height=300).mark_bar().encode(
-      x=alt.X('year_of_publication', sort=None),
-      y='mentions',
-   ))
+   col2.write(aggregates.year_range_chart())
 
    col2.text('')
    col2.write('By Author')
    col2.text('')
 
    # chart 3 - 7: by author
-   authordf = dispdf[['author(s)','mentions']].groupby('author(s)').sum().sort_values(by=['mentions'],ascending=False).reset_index()
-   split_dfs = np.array_split(authordf, int(authordf.shape[0]/(min(authordf.shape[0],15))))
-   for split_df in split_dfs:
-      col2.write(alt.Chart(split_df,width=400).mark_bar().encode(
-         x=alt.X('author(s)', sort=None),
-         y='mentions',
-      ))
+   for chart in aggregates.author_charts():
+      col2.write(chart)
    
    # footnotes
    for i in range(12):
@@ -301,11 +425,13 @@ def main():
 
    return sessiondf
 
-def bearer_oauth(r):
-   '''Method required by bearer token authentication.'''
-   r.headers["Authorization"] = f"Bearer {st.secrets.t_bearer_token}"
-   r.headers["User-Agent"] = "v2SampledStreamPython"
-   return r
+@st.experimental_singleton
+def get_counts_cache():
+   '''
+   Counts responses shared with the batch layer through S3.
+   A short ttl keeps the speed layer current while absorbing repeated reruns.
+   '''
+   return CountsCache(ttl=900, max_entries=1000, s3=boto3.client('s3'), bucket='warcbooks')
 
 def twitter_query_update_count(queries):
    '''
@@ -314,7 +440,8 @@ def twitter_query_update_count(queries):
    Output: dataframe of counts, the ending timestamp of last batch job
    '''
    column_names = ['request_url','start_date','end_date','tweet_count']
-   counts_df = pd.DataFrame(columns=column_names)      
+   counts = []
+   hourly = get_hourly()
    athena = boto3.client('athena', region_name='us-east-1')
    output = 's3://warcbooks/data/extracted/twitter/book_counts/athena/'
    for query in queries:
@@ -327,34 +454,57 @@ def twitter_query_update_count(queries):
       last_end_date = results['ResultSet']['Rows'][1]['Data'][0]['VarCharValue']
       last_end_date_q = last_end_date.split('.')[0].replace(':','%3A') + 'Z'
       url = f'{url}&start_time={last_end_date_q}'
-      # send request to twitter
-      response = requests.request("GET", url, auth=bearer_oauth, stream=True)
-      print(response.status_code)
-      if response.status_code==200:
-         for response_line in response.iter_lines():
-            if response_line:
-               json_response = json.loads(response_line)
-               if 'data' in json_response:
-                  for count in json_response['data']:
-                     start_date = count['start']
-                     end_date = count['end']
-                     tweet_count = count['tweet_count']
-                     cur_count = pd.DataFrame({'request_url':url, 'start_date':start_date, 'end_date': end_date, 'tweet_count':tweet_count}, index=[0])
-                     counts_df = counts_df.append(cur_count)
-         response.close()
-      elif response.status_code == 429:
+      # send request to twitter, unless the same request was answered recently
+      counts_cache = get_counts_cache()
+      hits = counts_cache.hits
+      json_response = counts_cache.get_or_fetch(url, fetch_counts)
+      metrics.counter('twitter_cache_hits', counts_cache.hits - hits)
+      if json_response is None:
          # if 'too many requests', do not move the cursor forward
          st.session_state['update_ind'] -= 1
-         response.close()
          time.sleep(60)
-      else:
-         raise Exception(
-            "Request returned an error: {} {}".format(
-                  response.status_code, response.text
-            )
-         )
+      elif 'data' in json_response:
+         for count in json_response['data']:
+            counts.append((url, count['start'], count['end'], count['tweet_count']))
+         # keep hourly buckets for exact rolling-window totals
+         if hourly is not None:
+            hourly.set_buckets(query, json_response['data'])
+            hourly.save()
+   counts_df = pd.DataFrame(counts, columns=column_names)
    return counts_df, last_end_date
 
+def hourly_version():
+   '''ETags of the hourly counts files'''
+   return s3_version(boto3.client('s3'), DATA_BUCKET, [HOURLY_KEY])
+
+def load_hourly():
+   '''Download the hourly counts and map them'''
+   local_path = '/tmp/twitterbooks_hourly'
+   for ext in ['.bin', '.json']:
+      wr.s3.download(path=f's3://{DATA_BUCKET}/{HOURLY_KEY}{ext}', local_file=local_path + ext + '.tmp')
+   for ext in ['.bin', '.json']:
+      os.replace(local_path + ext + '.tmp', local_path + ext)
+   return open_hourly(local_path)
+
+def get_hourly():
+   '''
+   Hourly counts of the top books from the last batch job, memory-mapped from local disk.
+   Updates by the app stay in the local copy until the batch job writes a new one.
+   Output: hourly.HourlyCounts, or None if the batch job hasn't written one
+   '''
+   try:
+      return shared_loader('hourly', hourly_version, load_hourly, interval=60).get()
+   except Exception as e:
+      print(e)
+      return None
+
+def fetch_counts(url):
+   '''
+   Request a counts url from twitter.
+   Output: json response, or None if rate-limited
+   '''
+   return request_counts(url, st.secrets.t_bearer_token)
+
 def get_query_results(athena, response):
    '''Get athena query results'''
    query_results = athena.get_query_results(QueryExecutionId=response['QueryExecutionId'])
@@ -375,6 +525,7 @@ def wait_query_success(athena, response):
    results = get_query_results(athena,response)
    return results
 
+@timed('athena_query')
 def athena_start_query_execution(athena, query, path):
    '''Execute Athena query with given query and output path and wait for success'''
    response = athena.start_query_execution(
@@ -410,7 +561,17 @@ def update_count(sessiondf):
          print(sessiondf.head())
          author = sessiondf.at[update_ind,'author(s)']
          title = sessiondf.at[update_ind,'shortened_title']
-         sessiondf.at[update_ind,'mentions'] += counts_df['tweet_count'][0]
+         # exact trailing 7-day count if the hourly buckets are known, otherwise add on top of last week's total
+         hourly = get_hourly()
+         window_total = hourly.total(queries[0]) if hourly is not None else None
+         old_mentions = sessiondf.at[update_ind,'mentions']
+         if window_total is not None:
+            sessiondf.at[update_ind,'mentions'] = window_total
+         else:
+            sessiondf.at[update_ind,'mentions'] += counts_df['tweet_count'][0]
+         # only this book changed, so pass the delta on to the chart aggregates
+         if 'chart_aggregates' in st.session_state:
+            st.session_state['chart_aggregates'].apply(int(sessiondf.at[update_ind,'year']), author, int(sessiondf.at[update_ind,'mentions'] - old_mentions))
          st.session_state[update_ind] = (title,author,sessiondf.at[update_ind,'year'],sessiondf.at[update_ind,'mentions'],sessiondf.at[update_ind,'query'])
          st.session_state['title'] = title
          st.session_state['author'] = author
@@ -433,4 +594,5 @@ def update_count(sessiondf):
 
 if __name__ == "__main__":
    sdf = main()
+   metrics.flush()
    update_count(sdf)
\ No newline at end of file